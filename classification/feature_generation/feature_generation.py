@@ -1,44 +1,141 @@
 import tensorflow as tf
 import numpy as np
-import posixpath as pp
 import os
 
-def filename_generator(filenames, random_state, weights):
+def filename_generator(filenames, random_state, weights, block_size=1024):
+    filenames = np.asarray(filenames)
     if weights is not None:
-        weights = np.array(weights)
-        weights /= weights.sum()
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = weights / weights.sum()
     while True:
-        yield random_state.choice(filenames, p=weights)
+        # `choice` converts its arguments and rebuilds the cumulative weights
+        # on each call, which is O(len(filenames)), so draw indices in blocks.
+        for ndx in random_state.choice(len(filenames), size=block_size, p=weights):
+            yield filenames[ndx]
+
+
+def batch_training_dataset(dataset, batch_size, shuffle_buffer):
+    """Shuffle and batch training or test examples, prefetching batches."""
+    return (dataset
+                .prefetch(shuffle_buffer)
+                .shuffle(shuffle_buffer)
+                .batch(batch_size)
+                .prefetch(tf.data.experimental.AUTOTUNE))
+
+
+def batch_prediction_dataset(dataset, batch_size):
+    """Batch inference examples in order, prefetching batches."""
+    return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
 
 
 def flatten_features(features, timestamps, time_ranges, id_):
     return tf.data.Dataset.from_tensor_slices((features, timestamps, time_ranges, id_))
 
 
-def set_feature_shapes(all_features, num_features, window_size):
+def set_batched_feature_shapes(all_features, num_features, window_size):
+    """Set shapes on features extracted by py_func, before flattening.
+
+    Setting these as soon as the py_func returns means everything downstream,
+    including the flattened per-window elements, has static shapes.
+    """
     features, timestamps, time_ranges, id_ = all_features
-    features.set_shape([window_size, num_features - 1]) 
-    timestamps.set_shape([window_size])
-    time_ranges.set_shape([2])
-    id_.set_shape([])
+    features.set_shape([None, window_size, num_features - 1])
+    timestamps.set_shape([None, window_size])
+    time_ranges.set_shape([None, 2])
+    id_.set_shape([None])
+
+
+def extract_n_random_fixed_times(features, id_, n, max_time_delta,
+                                 window_size, min_timeslice_size):
+    """In graph version of `feature_utilities.extract_n_random_fixed_times`.
+
+    Extracts n windows starting at random times from a single track using
+    native ops, so this runs in parallel in tf.data rather than calling back
+    into Python.
+
+    Args:
+        features: [length, num_features] float32 tensor, with the timestamp
+            in the first column (sorted ascending).
+        id_: scalar string tensor holding the id of the vessel.
+        n: the number of windows to extract.
+        max_time_delta: the maximum duration of a window in seconds.
+        window_size: the number of points in each window. Windows with fewer
+            points are repeated to fill it.
+        min_timeslice_size: the minimum number of points in a window.
+
+    Returns:
+        (features, timestamps, time_ranges, ids) for each window; empty if the
+        track is too short.
+    """
+    times = tf.cast(features[:, 0], tf.int64)
+    length = tf.shape(features)[0]
+    # Padding with one time keeps the lookups below in range for tracks too
+    # short to use.
+    padded_times = tf.concat([times, tf.zeros([1], tf.int64)], 0)
+    min_time = padded_times[0] - (window_size - min_timeslice_size)
+    max_time_due_to_ndx = padded_times[tf.maximum(length - min_timeslice_size, 0)]
+    max_time_due_to_time = padded_times[tf.maximum(length - 1, 0)] - max_time_delta
+    max_time = tf.minimum(max_time_due_to_ndx, max_time_due_to_time)
+    is_valid = (length >= min_timeslice_size) & (max_time >= min_time)
+    count = tf.where(is_valid, n, 0)
+
+    start_times = tf.random.uniform([count], min_time,
+                                    tf.maximum(max_time, min_time) + 1,
+                                    dtype=tf.int64)
+    starts = tf.searchsorted(times, start_times, side='left')
+    ends = tf.minimum(starts + window_size, length)
+    # Windows might only have min_timeslice_size points; these get repeated.
+    rows = (starts[:, tf.newaxis] +
+            tf.range(window_size)[tf.newaxis, :] % (ends - starts)[:, tf.newaxis])
+    windows = tf.gather(features, rows)
+    timestamps = tf.cast(windows[:, :, 0], tf.int32)
+    time_ranges = tf.stack([tf.reduce_min(timestamps, axis=1),
+                            tf.reduce_max(timestamps, axis=1)], axis=1)
+    return windows[:, :, 1:], timestamps, time_ranges, tf.fill([count], id_)
+
+
+def id_lookup_table(metadata):
+    """Table mapping the int64 id hashes stored in feature files back to ids.
+
+    The table has to be initialized before use. The Estimator does this with
+    its default tables_initializer, but datasets that use the table can't be
+    read with a one shot iterator: use an initializable iterator and run
+    tf.compat.v1.tables_initializer() along with its initializer.
+    """
+    hashes = sorted(metadata.id_map_int2bytes)
+    return tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            tf.constant(hashes, dtype=tf.int64),
+            tf.constant([metadata.id_map_int2bytes[x] for x in hashes],
+                        dtype=tf.string)),
+        default_value=b'')
+
 
+# The record schema is the same for every file, so build the specs once
+# rather than every time a parse function is traced.
+CONTEXT_FEATURES = {'id': tf.io.FixedLenFeature([], tf.int64)}
+_sequence_features = {}
 
 def parse_function_core(example_proto, num_features):
-    context_features, sequence_features = tf.io.parse_single_sequence_example(
-        example_proto,
-        context_features={
-            'id': tf.io.FixedLenFeature([], tf.int64)
-            },
-        sequence_features={
+    if num_features not in _sequence_features:
+        _sequence_features[num_features] = {
             'movement_features': tf.io.FixedLenSequenceFeature(shape=(num_features, ), 
                                                             dtype=tf.float32)
         }
+    context_features, sequence_features = tf.io.parse_single_sequence_example(
+        example_proto,
+        context_features=CONTEXT_FEATURES,
+        sequence_features=_sequence_features[num_features]
     )
     return context_features['id'], sequence_features['movement_features']
 
 def path2id(path):
-    return tf.compat.v1.py_func(
-            lambda p: pp.splitext(pp.basename(p))[0], [path], tf.string)
+    """Id from a feature file path, as in `splitext(basename(path))[0]`.
+
+    Uses native string ops so parallel maps aren't serialized on the GIL.
+    """
+    basename = tf.strings.regex_replace(path, r'^.*/', '')
+    return tf.strings.regex_replace(basename, r'(.)\.[^.]*$', r'\1')
 
 def read_input_fn_infinite(paths, num_features, num_parallel_reads=4, 
     random_state=None, weights=None):
@@ -68,18 +165,20 @@ def read_input_fn_one_shot(paths, num_features, num_parallel_reads=4):
     we return the real IDs as derived from the filenames.
     """
     
-    def parse_function(example_proto):
-        return parse_function_core(example_proto, num_features)
+    def parse_features(example_proto):
+        _, features = parse_function_core(example_proto, num_features)
+        return features
 
     path_ds_1 = tf.data.Dataset.from_tensor_slices(paths)
     path_ds_2 = tf.data.Dataset.from_tensor_slices(paths)
 
+    # The records are zipped with ids derived from the paths, so the files
+    # are read in order; parallel maps preserve that order.
     return tf.data.Dataset.zip((
         path_ds_1
-            .map(path2id),
+            .map(path2id, num_parallel_calls=num_parallel_reads),
         tf.data.TFRecordDataset(path_ds_2)
-            .map(parse_function)
-            .map(lambda id_, features: features)
+            .map(parse_features, num_parallel_calls=num_parallel_reads)
         ))
 
 
@@ -57,6 +57,33 @@ def test_read_input_fn_infinite():
     #                       6.1232343e-17,  1.0000000e+00, -8.6529666e-01,  2.8903718e+00,
     #                       0.0000000e+00,  0.0000000e+00,  0.0000000e+00])
 
+def test_extract_n_random_fixed_times():
+    times = np.arange(1000, 1600, 10, dtype=np.float32)
+    series = np.stack([times, times + 1, times + 2], axis=1)
+    windows = feature_generation.extract_n_random_fixed_times(
+                    tf.constant(series), tf.constant(b'1'), 5, 100, 8, 4)
+    short = feature_generation.extract_n_random_fixed_times(
+                    tf.constant(series[:3]), tf.constant(b'1'), 5, 100, 8, 4)
+    with tf.Session() as sess:
+        (features, timestamps, ranges, ids), short = sess.run([windows, short])
+    assert features.shape == (5, 8, 2)
+    assert timestamps.shape == (5, 8)
+    assert list(ids) == [b'1'] * 5
+    assert (features[:, :, 0] == timestamps + 1).all()
+    assert (np.diff(timestamps, axis=1) == 10).all()
+    assert (ranges == timestamps[:, [0, -1]]).all()
+    assert [x.shape[0] for x in short] == [0, 0, 0, 0]
+
+
+def test_path2id():
+    paths = [b'gs://bucket/features/416853000.tfrecord', b'a/b.c.tfrecord',
+             b'123456789']
+    ids = feature_generation.path2id(tf.constant(paths))
+    with tf.Session() as sess:
+        ids = sess.run(ids)
+    assert list(ids) == [pp.splitext(pp.basename(x))[0] for x in paths]
+
+
 if __name__ == '__main__':
     tf.test.main()
 
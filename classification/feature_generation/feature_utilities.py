@@ -19,10 +19,83 @@ import numpy as np
 import six
 import time
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 EPOCH_DT = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
 
 
+def dense_fishing_labels(timestamps, starts, ends, is_fishing, order):
+    """ Label each timestamp with the fishing range that contains it.
+
+  Where ranges overlap, the containing range with the highest `order` wins,
+  the same as assigning each range's label in file order.
+
+  Args:
+    timestamps: a numpy array of timestamps in seconds from the Unix epoch.
+    starts: a numpy array of range start times, sorted ascending.
+    ends: a numpy array of (inclusive) range end times.
+    is_fishing: a numpy array with the label of each range.
+    order: a numpy array with the position of each range in the original
+      (file) order.
+
+  Returns:
+    a float32 numpy array the same length as timestamps, holding the label of
+    the range containing each timestamp, or -1 if there is no such range.
+  """
+    dense_labels = np.full(len(timestamps), -1.0, dtype=np.float32)
+    if not len(starts):
+        return dense_labels
+    reach = np.maximum.accumulate(ends)
+    if (starts[1:] <= reach[:-1]).any():
+        # Overlapping ranges are rare, so just assign each range in turn.
+        for k in np.argsort(order):
+            dense_labels[(timestamps >= starts[k]) &
+                         (timestamps <= ends[k])] = is_fishing[k]
+        return dense_labels
+    ndxs = np.searchsorted(starts, timestamps, side='right') - 1
+    valid = (ndxs >= 0) & (timestamps <= ends[np.maximum(ndxs, 0)])
+    dense_labels[valid] = is_fishing[ndxs[valid]]
+    return dense_labels
+
+
+_dense_fishing_labels_numpy = dense_fishing_labels
+
+
+def _dense_fishing_labels_kernel(timestamps, starts, ends, is_fishing, order):
+    # Loop form of `dense_fishing_labels` for Numba, which fuses the search
+    # and the assignment and runs without holding the GIL. Every range up to
+    # the one found by the search starts in time, so walk back over those
+    # that might still contain t, stopping once no earlier range reaches it,
+    # and keep the containing range that comes last in file order.
+    dense_labels = np.empty(len(timestamps), dtype=np.float32)
+    reach = np.empty_like(ends)
+    if len(ends):
+        reach[0] = ends[0]
+    for j in range(1, len(ends)):
+        reach[j] = max(reach[j - 1], ends[j])
+    ndxs = np.searchsorted(starts, timestamps, side='right') - 1
+    for i in range(len(timestamps)):
+        dense_labels[i] = -1.0
+        best = -1
+        j = ndxs[i]
+        while j >= 0 and timestamps[i] <= reach[j]:
+            if timestamps[i] <= ends[j] and (best < 0 or order[j] > order[best]):
+                best = j
+            j -= 1
+        if best >= 0:
+            dense_labels[i] = is_fishing[best]
+    return dense_labels
+
+
+if numba is not None:
+    dense_fishing_labels = numba.njit(nogil=True, cache=True)(
+                                            _dense_fishing_labels_kernel)
+
+
 def np_pad_repeat_slice(slice, window_size):
     """ Pads slice to the specified window size.
 
@@ -38,11 +111,9 @@ def np_pad_repeat_slice(slice, window_size):
 
     slice_length = len(slice)
     assert (slice_length <= window_size)
-    reps = int(np.ceil(window_size / float(slice_length)))
-    if reps > 1:
-        return np.concatenate([slice] * reps, axis=0)[:window_size]
-    else:
-        return slice[:window_size].copy()
+    # Gather with wrapped indices so the output is allocated once, rather
+    # than concatenating `reps` copies and truncating.
+    return np.take(slice, np.arange(window_size), axis=0, mode='wrap')
 
 def np_zero_pad_slice(slice, window_size, random_state):
     """ Pads slice to the specified window size.
@@ -96,10 +167,10 @@ def np_pad_repeat_slice_2(slice, window_size, random_state):
     slice = slice.copy()
     GAP_LOGDT = 100
     slice[0, 1] = GAP_LOGDT
-    reps = int(np.ceil(window_size / float(slice_length)))
-    repeated = np.concatenate([slice] * reps, axis=0)
     offset = random_state.randint(0, window_size)
-    return np.roll(repeated, offset, axis=0)[:window_size]
+    # Equivalent to rolling the repeated series by offset and truncating.
+    return np.take(slice, np.arange(-offset, window_size - offset), axis=0,
+                   mode='wrap')
 
 def np_array_random_fixed_length_extract(random_state, input_series,
                                          output_length):
@@ -141,7 +212,9 @@ def cook_features(features, id_):
     timestamps = features[:, 0].astype(np.int32)
     features = features[:, 1:]
 
-    if not np.isfinite(features).all():
+    # A sanity check rather than something the model needs, so skip the extra
+    # pass over every window when running with `python -O`.
+    if __debug__ and not np.isfinite(features).all():
         logging.fatal('Bad features: %s', features)
 
     return (np.stack([features]), 
@@ -152,7 +225,7 @@ def cook_features(features, id_):
 
 def extract_n_random_fixed_points(random_state, input_series, n,
                                        output_length, id_,
-                                       selection_ranges):
+                                       range_starts, range_ends):
     """ Extracts a n, random fixed-points slice from a 2d numpy array.
     
     The input array must be 2d, representing a time series, with the first    
@@ -166,44 +239,44 @@ def extract_n_random_fixed_points(random_state, input_series, n,
         output_length: the number of points in the output series. Input series    
             shorter than this will be repeated into the output series.   
         id_: the id of the vessel
-        selection_ranges: Either a list of time ranges that should be preferentially 
-            selected from (we try to get at least on point from one of the ranges), or 
-            None if to disable this behaviour. 
+        range_starts: array of start times, in seconds from the Unix epoch, of
+            ranges to select from (we try to get at least one point from one 
+            of the ranges).
+        range_ends: array of the corresponding range end times.
 
     Returns:    
         An array of the same depth as the input, but altered width, representing
         the fixed points slice.   
     """
     input_length = len(input_series)
+    empty_arrays = setup_cook_features_into(0, (output_length, input_series.shape[-1]))
     if input_length < output_length:
-        return empty_data(output_length, input_series)
-
-    # Set of points where it would make sense to start a range.
-    candidate_set = set()
-
-    starts = [(x.start_time - EPOCH_DT).total_seconds() for x in selection_ranges]
-    starts_ndxs = np.searchsorted(input_series[:, 0], starts, side='left')
-
-    ends = [(x.end_time - EPOCH_DT).total_seconds() for x in selection_ranges]
-    end_ndxs = np.searchsorted(input_series[:, 0], ends, side='right')
-
-    for start_ndx, end_ndx in zip(starts_ndxs, end_ndxs):
-        valid_start = max(0, start_ndx - output_length + 1)
-        valid_end = min(input_length - output_length + 1, end_ndx)
-        candidate_set.update(range(valid_start, valid_end))
-
-    candidates = list(candidate_set)
+        return empty_arrays
+
+    # Points where it would make sense to start a range: the union of the
+    # intervals [valid_start, valid_end) over all ranges, found by summing
+    # +1/-1 markers at the interval bounds rather than building a set.
+    # searchsorted needs a contiguous array, so copy the time column once
+    # rather than letting each call do it.
+    times = np.ascontiguousarray(input_series[:, 0])
+    starts_ndxs = np.searchsorted(times, range_starts, side='left')
+    end_ndxs = np.searchsorted(times, range_ends, side='right')
+    num_starts = input_length - output_length + 1
+    valid_starts = np.maximum(0, starts_ndxs - output_length + 1)
+    valid_ends = np.minimum(num_starts, end_ndxs)
+    nonempty = valid_ends > valid_starts
+    markers = (np.bincount(valid_starts[nonempty], minlength=num_starts + 1) -
+               np.bincount(valid_ends[nonempty], minlength=num_starts + 1))
+    candidates = np.flatnonzero(np.cumsum(markers[:-1]) > 0)
 
     if len(candidates) == 0:
-        return empty_data(output_length, input_series)
+        return empty_arrays
 
-    samples = []
-    for _ in range(n):
-        start_index = random_state.choice(candidates)
-        end_index = start_index + output_length
-        samples.append(cook_features(input_series[start_index:end_index], id_))
+    starts = random_state.choice(candidates, size=n)
+    arrays = setup_cook_features_into(n, (output_length, input_series.shape[-1]))
+    cook_windows_into(arrays, input_series, starts, starts + output_length, id_)
 
-    return list(zip(*samples))
+    return arrays
 
 
 
@@ -243,6 +316,63 @@ def cook_features_into(arrays, i, data, id_, range_=None):
         ranges[i, :] = range_
     ids[i] = id_
 
+
+def _cook_windows(input_series, starts, ends, features, timestamps, ranges):
+    # Gather every window, repeated to fill window_size, with one fancy index.
+    offsets = np.arange(timestamps.shape[1])
+    rows = starts[:, np.newaxis] + offsets % (ends - starts)[:, np.newaxis]
+    windows = input_series[rows]
+    features[:] = windows[:, :, 1:]
+    timestamps[:] = windows[:, :, 0]
+    ranges[:, 0] = windows[:, :, 0].min(axis=1)
+    ranges[:, 1] = windows[:, :, 0].max(axis=1)
+
+
+_cook_windows_numpy = _cook_windows
+
+
+def _cook_windows_kernel(input_series, starts, ends, features, timestamps, ranges):
+    # Loop form of `_cook_windows` for Numba, which copies each padded window
+    # straight into the outputs without temporaries and releases the GIL.
+    window_size = timestamps.shape[1]
+    depth = input_series.shape[1]
+    for i in range(len(starts)):
+        length = ends[i] - starts[i]
+        t_min = input_series[starts[i], 0]
+        t_max = t_min
+        for j in range(window_size):
+            row = starts[i] + j % length
+            t = input_series[row, 0]
+            t_min = min(t_min, t)
+            t_max = max(t_max, t)
+            timestamps[i, j] = int(t)
+            for k in range(1, depth):
+                features[i, j, k - 1] = input_series[row, k]
+        ranges[i, 0] = int(t_min)
+        ranges[i, 1] = int(t_max)
+
+
+if numba is not None:
+    _cook_windows = numba.njit(nogil=True, cache=True)(_cook_windows_kernel)
+
+
+def cook_windows_into(arrays, input_series, starts, ends, id_):
+    """Cook the windows input_series[starts[i]:ends[i]] into arrays.
+
+    Windows shorter than the output window size are repeated to fill it.
+
+        Args:
+            arrays: (features, timestamps, ranges, ids) as returned by
+                `setup_cook_features_into`, with one row per window.
+            input_series: np.array of raw features.
+            starts: int64 np.array of window start indices.
+            ends: int64 np.array of window end indices.
+            id_: the id associated with these features.
+    """
+    features, timestamps, ranges, ids = arrays
+    _cook_windows(input_series, starts, ends, features, timestamps, ranges)
+    ids[:] = id_
+
 def extract_n_random_fixed_times(random_state, input_series, n,
                                        max_time_delta, output_length,
                                        id_, min_timeslice_size):
@@ -269,8 +399,9 @@ def extract_n_random_fixed_times(random_state, input_series, n,
     """
     assert max_time_delta != 0, 'max_time_delta must be non zero for time based windows'
     input_length = len(input_series)
+    empty_arrays = setup_cook_features_into(0, (output_length, input_series.shape[-1]))
     if input_length < min_timeslice_size:
-        return empty_data(output_length, input_series)
+        return empty_arrays
 
     min_time = input_series[0, 0] - (output_length - min_timeslice_size)
     max_ndx = input_length - min_timeslice_size
@@ -279,17 +410,14 @@ def extract_n_random_fixed_times(random_state, input_series, n,
     max_time = min(max_time_due_to_ndx, max_time_due_to_time)
 
     if max_time < min_time:
-        return empty_data(output_length, input_series)
+        return empty_arrays
 
-    # TODO: clarify by breaking into two function
+    start_times = random_state.randint(min_time, max_time + 1, size=n)
+    starts = np.searchsorted(input_series[:, 0], start_times, side='left')
+    # Windows might only have min_timeslice_size points; these get repeated.
+    ends = np.minimum(starts + output_length, input_length)
     arrays = setup_cook_features_into(n, (output_length, input_series.shape[-1]))
-    for i in range(n):
-        start_time = random_state.randint(min_time, max_time + 1)
-        start_index = np.searchsorted(input_series[:, 0], start_time, side='left')
-        end_index = start_index + output_length
-        cropped = input_series[start_index:end_index] # Might only have min_timeslice_size points
-        padded = np_pad_repeat_slice(cropped, output_length)
-        cook_features_into(arrays, i, padded, id_)
+    cook_windows_into(arrays, input_series, starts, ends, id_)
 
     return arrays
 
@@ -322,50 +450,58 @@ def np_array_extract_slices_for_time_ranges(
         4. A numpy array with an int64 id for each slice, of dimension [n].
 
     """
-    times = input_series[:, 0]
-    ndx = 0
-    arrays = setup_cook_features_into(len(time_ranges), 
-                        (window_size, input_series.shape[-1]))
-    for (start_time, end_time) in time_ranges:
-        start_index = np.searchsorted(times, start_time, side='left')
-        end_index = np.searchsorted(times, end_time, side='left')
-        length = end_index - start_index
-
-        # Slice out the time window.
-        cropped = input_series[start_index:end_index]
+    time_ranges = np.asarray(time_ranges, dtype=np.int64).reshape(-1, 2)
+    # Both bounds use side='left', so look them all up in one call.
+    indices = np.searchsorted(input_series[:, 0], time_ranges.ravel(), side='left')
+    start_indices, end_indices = indices.reshape(-1, 2).T
 
-        # If this window is too long, pick a random subwindow.
+    # If a window is too long, keep its last window_size points.
+    start_indices = np.maximum(start_indices, end_indices - window_size)
+    usable = end_indices - start_indices >= min_points_for_classification
 
-        if (length > window_size):
-            max_offset = length - window_size
-            start_offset = random_state.uniform(max_offset)
-            cropped = cropped[max_offset:max_offset + window_size]
-
-        if len(cropped) >= min_points_for_classification:
-            padded = np_pad_repeat_slice(cropped, window_size)
-            cook_features_into(arrays, ndx, padded, id_, (start_time, end_time))
-            ndx += 1
-    return tuple(x[:ndx] for x in arrays)
+    arrays = setup_cook_features_into(usable.sum(),
+                        (window_size, input_series.shape[-1]))
+    cook_windows_into(arrays, input_series, start_indices[usable],
+                      end_indices[usable], id_)
+    arrays[2][:] = time_ranges[usable]
+    return arrays
 
 def np_array_extract_all_fixed_slices(input_series, num_features, id_,
                                       window_size, shift):
-    slices = []
+    """ Extract every window of window_size points, stepping back by shift
+        from the end of the series.
+
+    Returns the windows latest first, in the same layout as stacking the
+    output of `cook_features` for each window.
+    """
     input_length = len(input_series)
-    for end_index in range(input_length, 0, -shift):
-        start_index = end_index - window_size
-        if start_index < 0:
-            if start_index != -shift:
-                logging.warning('input not correctly padded, dropping start')
-            continue
-        cropped = input_series[start_index:end_index]
-        start_time = int(cropped[0][0])
-        end_time = int(cropped[-1][0])
-        time_bounds = np.array([start_time, end_time], dtype=np.int32)
-        assert len(cropped) == window_size
-        slices.append(cook_features(cropped, id_))
-    if slices == []:
+    n = (input_length - window_size) // shift + 1 if input_length >= window_size else 0
+    # Windows that would run off the start are dropped; that should only ever
+    # be the single window starting at -shift if the input was padded right.
+    dropped_starts = (input_length - window_size -
+                      shift * np.arange(n, -(-input_length // shift)))
+    if (dropped_starts != -shift).any():
+        logging.warning('input not correctly padded, dropping start')
+    if n == 0:
         return empty_data(window_size, input_series)
-    return list(zip(*slices))
+
+    # View every window at once without copying, then reverse so the latest
+    # window comes first.
+    first = input_length - window_size - shift * (n - 1)
+    row_stride, col_stride = input_series.strides
+    windows = np.lib.stride_tricks.as_strided(input_series[first:],
+                    shape=(n, window_size, input_series.shape[1]),
+                    strides=(shift * row_stride, row_stride, col_stride),
+                    writeable=False)[::-1]
+
+    features = np.array(windows[:, np.newaxis, :, 1:], dtype=np.float32)
+    if __debug__ and not np.isfinite(features).all():
+        logging.fatal('Bad features: %s', features)
+    timestamps = windows[:, :, 0].astype(np.int32)
+    time_ranges = np.stack([timestamps.min(axis=1), timestamps.max(axis=1)], axis=1)
+    ids = np.empty([n], dtype=object)
+    ids[:] = id_
+    return features, timestamps, time_ranges, ids
 
 
 
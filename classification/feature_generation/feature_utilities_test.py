@@ -0,0 +1,166 @@
+# Copyright 2017 Google Inc. and Skytruth Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from . import feature_utilities
+
+
+_DENSE_FISHING_LABELS = [feature_utilities.dense_fishing_labels,
+                         feature_utilities._dense_fishing_labels_numpy,
+                         feature_utilities._dense_fishing_labels_kernel]
+
+
+def _sorted_ranges(starts, ends, is_fishing):
+    # Sort ranges given in file order the way VesselMetadata does.
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order], is_fishing[order], order
+
+
+def _per_range_labels(timestamps, starts, ends, is_fishing):
+    # Assign each range in file order, so later ranges overwrite earlier ones.
+    labels = np.full(len(timestamps), -1.0, dtype=np.float32)
+    for start, end, label in zip(starts, ends, is_fishing):
+        labels[(timestamps >= start) & (timestamps <= end)] = label
+    return labels
+
+
+def test_dense_fishing_labels():
+    starts = np.array([10, 20, 40], dtype=np.int64)
+    ends = np.array([15, 30, 50], dtype=np.int64)
+    is_fishing = np.array([1.0, 0.0, 1.0], dtype=np.float32)
+    order = np.arange(3)
+    timestamps = np.array([5, 10, 15, 16, 20, 30, 35, 50, 51], dtype=np.int32)
+    expected = [-1, 1, 1, -1, 0, 0, -1, 1, -1]
+    for label in _DENSE_FISHING_LABELS:
+        labels = label(timestamps, starts, ends, is_fishing, order)
+        assert labels.dtype == np.float32
+        assert labels.tolist() == expected
+        labels = label(timestamps, starts[:0], ends[:0], is_fishing[:0],
+                       order[:0])
+        assert labels.tolist() == [-1] * len(timestamps)
+
+
+def test_dense_fishing_labels_nested():
+    # Points inside the outer range but past the inner one keep the outer
+    # label; within the inner range the later range wins.
+    starts = np.array([10, 12, 20, 30], dtype=np.int64)
+    ends = np.array([25, 15, 22, 40], dtype=np.int64)
+    is_fishing = np.array([0.0, 1.0, 1.0, 0.0], dtype=np.float32)
+    timestamps = np.array([9, 10, 12, 15, 16, 20, 23, 25, 26, 30], dtype=np.int32)
+    expected = [-1, 0, 1, 1, 0, 1, 0, 0, -1, 0]
+    for label in _DENSE_FISHING_LABELS:
+        labels = label(timestamps, starts, ends, is_fishing, np.arange(4))
+        assert labels.tolist() == expected
+    # Ranges listed out of start order: the later row in the file wins where
+    # they overlap, even though it starts first.
+    ranges = _sorted_ranges(np.array([10, 5], dtype=np.int64),
+                            np.array([30, 20], dtype=np.int64),
+                            np.array([1.0, 0.0], dtype=np.float32))
+    timestamps = np.arange(0, 31, 5, dtype=np.int32)
+    expected = [-1, 0, 0, 0, 0, 1, 1]
+    for label in _DENSE_FISHING_LABELS:
+        labels = label(timestamps, *ranges)
+        assert labels.tolist() == expected
+
+
+def test_dense_fishing_labels_implementations_agree():
+    random_state = np.random.RandomState(0)
+    for _ in range(200):
+        n = random_state.randint(0, 6)
+        starts = random_state.randint(0, 100, n).astype(np.int64)
+        ends = starts + random_state.randint(0, 40, n)
+        is_fishing = random_state.randint(0, 3, n).astype(np.float32)
+        timestamps = random_state.randint(-5, 150, 50).astype(np.int32)
+        expected = _per_range_labels(timestamps, starts, ends, is_fishing)
+        ranges = _sorted_ranges(starts, ends, is_fishing)
+        for label in _DENSE_FISHING_LABELS:
+            labels = label(timestamps, *ranges)
+            assert labels.tolist() == expected.tolist()
+
+
+def test_extract_n_random_fixed_points():
+    input_series = np.arange(40, dtype=np.float32).reshape(10, 4)
+    starts = np.array([3], dtype=np.int64)
+    ends = np.array([5], dtype=np.int64)
+    random_state = np.random.RandomState(0)
+    features, timestamps, ranges, ids = \
+        feature_utilities.extract_n_random_fixed_points(
+            random_state, input_series, 5, 4, b'1', starts, ends)
+    assert features.shape == (5, 4, 3)
+    assert timestamps.shape == (5, 4)
+    assert list(ids) == [b'1'] * 5
+    for f, t, r in zip(features, timestamps, ranges):
+        assert (f[:, 0] == t + 1).all()
+        assert r.tolist() == [t[0], t[-1]]
+        # At least one point falls within the selection range.
+        assert ((t >= 3) & (t <= 5)).any()
+    features, _, _, _ = feature_utilities.extract_n_random_fixed_points(
+            random_state, input_series, 5, 4, b'1', starts[:0], ends[:0])
+    assert features.shape == (0, 4, 3)
+
+
+def test_np_pad_repeat_slice():
+    slice = np.arange(6, dtype=np.float32).reshape(3, 2)
+    padded = feature_utilities.np_pad_repeat_slice(slice, 7)
+    assert padded.dtype == np.float32
+    assert padded[:, 0].tolist() == [0, 2, 4, 0, 2, 4, 0]
+    padded = feature_utilities.np_pad_repeat_slice(slice, 3)
+    assert (padded == slice).all()
+    assert padded is not slice
+
+
+def test_cook_windows():
+    input_series = np.arange(40, dtype=np.float32).reshape(10, 4)
+    starts = np.array([0, 6], dtype=np.int64)
+    ends = np.array([5, 8], dtype=np.int64)
+    for cook in [feature_utilities._cook_windows,
+                 feature_utilities._cook_windows_numpy,
+                 feature_utilities._cook_windows_kernel]:
+        features, timestamps, ranges, ids = \
+            feature_utilities.setup_cook_features_into(2, (5, 4))
+        cook(input_series, starts, ends, features, timestamps, ranges)
+        assert timestamps.tolist() == [[0, 4, 8, 12, 16], [24, 28, 24, 28, 24]]
+        assert (features[:, :, 0] == timestamps + 1).all()
+        assert ranges.tolist() == [[0, 16], [24, 28]]
+
+
+def test_cook_windows_implementations_agree():
+    random_state = np.random.RandomState(0)
+    input_series = random_state.uniform(size=(50, 5)).astype(np.float32)
+    input_series[:, 0] = np.cumsum(random_state.randint(1, 100, 50))
+    starts = random_state.randint(0, 45, 20).astype(np.int64)
+    ends = np.minimum(starts + random_state.randint(1, 12, 20), 50)
+    results = []
+    for cook in [feature_utilities._cook_windows_numpy,
+                 feature_utilities._cook_windows]:
+        arrays = feature_utilities.setup_cook_features_into(20, (8, 5))
+        cook(input_series, starts, ends, *arrays[:3])
+        results.append(arrays[:3])
+    for expected, actual in zip(*results):
+        assert (expected == actual).all()
+
+
+def test_np_array_extract_all_fixed_slices():
+    input_series = np.arange(40, dtype=np.float32).reshape(10, 4)
+    features, timestamps, ranges, ids = \
+        feature_utilities.np_array_extract_all_fixed_slices(
+            input_series, 4, b'1', 4, 3)
+    assert features.shape == (3, 1, 4, 3)
+    assert timestamps[:, 0].tolist() == [24, 12, 0]
+    assert (features[:, 0, :, 0] == timestamps + 1).all()
+    assert ranges.tolist() == [[24, 36], [12, 24], [0, 12]]
+    assert list(ids) == [b'1'] * 3
+    features, _, _, _ = feature_utilities.np_array_extract_all_fixed_slices(
+            input_series[:3], 4, b'1', 4, 3)
+    assert features.shape == (0, 1, 4, 3)
@@ -1,4 +1,3 @@
-import calendar
 import numpy as np
 import os
 import tensorflow as tf
@@ -18,59 +17,53 @@ def input_fn(metadata,
 
     random_state = np.random.RandomState()
 
+    # Ranges are stored as arrays sorted by start time so that labels can be
+    # assigned with a single searchsorted per sample rather than a Python
+    # loop over every range. Each range also keeps its position in the
+    # fishing ranges file, so that where ranges overlap a point takes the
+    # label of the containing range that comes last in the file, as when each
+    # range was assigned in turn.
+    fishing_ranges_map = metadata.fishing_range_arrays()
+    no_ranges = (np.empty([0], dtype=np.int64), np.empty([0], dtype=np.int64),
+                 np.empty([0], dtype=np.float32), np.empty([0], dtype=np.int64))
+
     weights = []
     for p in filenames:
         id_, _ = os.path.splitext(os.path.basename(p))
         id_ = six.ensure_binary(id_)
         weights.append(metadata.vessel_weight(id_))
     
+    id_table = feature_generation.id_lookup_table(metadata)
+
     def xform(id_, movement_features):
+        id_ = id_table.lookup(id_)
 
         def _xform(id_, features):
-            # Extract several random windows from each vessel track
-            id_ = metadata.id_map_int2bytes[id_]
-            ranges = metadata.fishing_ranges_map.get(id_, {})
-            return feature_utilities.extract_n_random_fixed_points(
+            # Extract several random windows from each vessel track and label
+            # them in the same call, so there is one trip into Python per
+            # track rather than one per window.
+            starts, ends, is_fishing, order = fishing_ranges_map.get(
+                                                        id_, no_ranges)
+            arrays = feature_utilities.extract_n_random_fixed_points(
                             random_state, features, num_slices_per_id,
-                            window_size, id_, ranges)
+                            window_size, id_, starts, ends)
+            timestamps = arrays[1]
+            labels = feature_utilities.dense_fishing_labels(
+                        timestamps.ravel(), starts, ends, is_fishing, order)
+            return arrays + (labels.reshape(timestamps.shape),)
 
-        features, timestamps, time_ranges, id_ = tf.compat.v1.py_func(
+        all_features = tf.compat.v1.py_func(
             _xform, 
             [id_, movement_features],
-            [tf.float32, tf.int32, tf.int32, tf.string])
-        features = tf.squeeze(features, axis=1)
-        return (features, timestamps, time_ranges, id_)
-
-    fishing_ranges_map = {}
-    for k, v in metadata.fishing_ranges_map.items():
-        fishing_ranges_map[k] = []
-        for sel_range in v:
-            start_range = calendar.timegm(sel_range.start_time.utctimetuple())
-            end_range = calendar.timegm(sel_range.end_time.utctimetuple())
-            fishing_ranges_map[k].append((start_range, end_range, sel_range.is_fishing))
-
-    def add_labels(features, timestamps, time_bounds, id_):
-
-        def _add_labels(id_, timestamps):
-            dense_labels = np.empty_like(timestamps, dtype=np.float32)
-            dense_labels.fill(-1.0)
-            if id_ in fishing_ranges_map:
-                for start_range, end_range, is_fishing in fishing_ranges_map[id_]:
-                    start_ndx = np.searchsorted(timestamps, start_range, side='left')
-                    end_ndx = np.searchsorted(timestamps, end_range, side='right')
-                    dense_labels[start_ndx:end_ndx] = is_fishing
-            return dense_labels
-
-        [labels] =  tf.compat.v1.py_func(
-            _add_labels, 
-            [id_, timestamps],
-            [tf.float32])
-        return ((features, timestamps, time_bounds, id_), labels)
-
-    def set_shapes(all_features, labels):
-        feature_generation.set_feature_shapes(all_features, num_features, window_size)
-        labels.set_shape([window_size])
-        return all_features, labels
+            [tf.float32, tf.int32, tf.int32, tf.string, tf.float32])
+        all_features, labels = all_features[:4], all_features[4]
+        feature_generation.set_batched_feature_shapes(
+            all_features, num_features, window_size)
+        labels.set_shape([None, window_size])
+        return tuple(all_features), labels
+
+    def flatten_labelled_features(features, labels):
+        return tf.data.Dataset.from_tensor_slices((features, labels))
 
     def features_as_dict(features, labels):
         features, timestamps, time_bounds, id_ = features
@@ -86,9 +79,7 @@ def input_fn(metadata,
 
     return (raw_data
                 .map(xform, num_parallel_calls=parallelism)
-                .flat_map(feature_generation.flatten_features)
-                .map(add_labels, num_parallel_calls=parallelism)
-                .map(set_shapes)
+                .flat_map(flatten_labelled_features)
                 .map(features_as_dict)
            )
 
@@ -129,12 +120,10 @@ def predict_input_fn(paths,
             _xform, 
             [id_, movement_features],
             [tf.float32, tf.int32, tf.int32, tf.string])
-        features = tf.squeeze(features, axis=1)
-        return (features, timestamps, time_ranges_tensor, id_)
-
-    def set_shapes(features, timestamps, time_bounds, id_):
-        all_features = features, timestamps, time_bounds, id_
-        feature_generation.set_feature_shapes(all_features, num_features, window_size)
+        all_features = (tf.squeeze(features, axis=1), timestamps, 
+                        time_ranges_tensor, id_)
+        feature_generation.set_batched_feature_shapes(
+            all_features, num_features, window_size)
         return all_features
 
     def features_as_dict(features, timestamps, time_bounds, id_):
@@ -146,7 +135,6 @@ def predict_input_fn(paths,
     return (raw_data
                 .map(xform, num_parallel_calls=parallelism)
                 .flat_map(feature_generation.flatten_features)
-                .map(set_shapes)
                 .map(features_as_dict)
            )
 
@@ -18,40 +18,48 @@ def input_fn(
              num_slices_per_id=4):
 
     random_state = np.random.RandomState()
+    id_table = feature_generation.id_lookup_table(metadata)
 
     def xform(id_, movement_features):
-
-        def _xform(id_, features):
-            id_ = metadata.id_map_int2bytes[id_]
-            return feature_utilities.extract_n_random_fixed_times(
-                    random_state, features, num_slices_per_id, max_time_delta,
-                    window_size, id_, min_timeslice_size)
-
-        features, timestamps, time_ranges, id_ = tf.py_func(
-            _xform, 
-            [id_, movement_features],
-            [tf.float32, tf.int32, tf.int32, tf.string])
-        return (features, timestamps, time_ranges, id_)
+        all_features = feature_generation.extract_n_random_fixed_times(
+            movement_features, id_table.lookup(id_), num_slices_per_id,
+            max_time_delta, window_size, min_timeslice_size)
+        feature_generation.set_batched_feature_shapes(
+            all_features, num_features, window_size)
+        return tuple(all_features)
+
+    # Vessel labels only depend on the id, so build a table of labels for
+    # every known id up front and look them up in graph rather than calling
+    # back into Python for every sample. This is a StaticHashTable rather than
+    # a MutableDenseHashTable since ids are strings at this point and dense
+    # tables need an explicit insert op run after the session is created,
+    # which input_fn has no way to schedule; the static table is filled by
+    # the Estimator's default tables_initializer.
+    label_ids = sorted(metadata.metadata_by_id)
+    label_index = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            tf.constant(label_ids, dtype=tf.string),
+            tf.range(len(label_ids), dtype=tf.int64)),
+        default_value=-1)
+    # All objectives' labels are packed side by side into one matrix so that
+    # a single gather fetches every label for a sample.
+    label_values = []
+    label_widths = []
+    for obj in objectives:
+        width = int(np.prod(obj.output_shape))
+        values = np.array([obj.create_label(x, None) for x in label_ids],
+                          dtype=np.float32)
+        label_values.append(values.reshape([len(label_ids), width]))
+        label_widths.append(width)
+    label_matrix = tf.constant(np.concatenate(label_values, axis=1))
 
     def add_labels(features, timestamps, time_bounds, id_):
-
-        def _add_labels(id_, timestamps):
-            labels = [o.create_label(id_, timestamps) for o in objectives]
-            return labels
-
-        labels =  tf.py_func(
-            _add_labels, 
-            [id_, timestamps],
-            [tf.float32] * len(objectives))
+        ndx = label_index.lookup(id_)
+        packed = tf.split(tf.gather(label_matrix, ndx), label_widths)
+        labels = [tf.reshape(x, obj.output_shape)
+                    for (x, obj) in zip(packed, objectives)]
         return ((features, timestamps, time_bounds, id_), tuple(labels))
 
-    def set_shapes(all_features, labels):
-        feature_generation.set_feature_shapes(all_features, num_features, window_size)
-        for i, obj in enumerate(objectives):
-            t = labels[i]
-            t.set_shape(obj.output_shape)
-        return all_features, labels
-
     def lbls_as_dict(features, labels):
         d = {obj.name : labels[i] for (i, obj) in enumerate(objectives)}
         return features, d
@@ -71,7 +79,6 @@ def input_fn(
                 .map(xform, num_parallel_calls=parallelism)
                 .flat_map(feature_generation.flatten_features)
                 .map(add_labels, num_parallel_calls=parallelism)
-                .map(set_shapes, num_parallel_calls=parallelism)
                 .map(lbls_as_dict, num_parallel_calls=parallelism)
                 .map(features_as_dict, num_parallel_calls=parallelism)
            )
@@ -94,16 +101,13 @@ def predict_input_fn(paths,
                     window_size, min_timeslice_size)
 
         raw_features = tf.cast(movement_features, tf.float32)
-        features, timestamps, time_ranges_tensor, id_ = tf.py_func(
+        all_features = tf.py_func(
             _xform, 
             [id_, raw_features],
             [tf.float32, tf.int32, tf.int32, tf.string])
-        return (features, timestamps, time_ranges_tensor, id_)
-
-    def set_shapes(features, timestamps, time_bounds, id_):
-        all_features = features, timestamps, time_bounds, id_
-        feature_generation.set_feature_shapes(all_features, num_features, window_size)
-        return all_features
+        feature_generation.set_batched_feature_shapes(
+            all_features, num_features, window_size)
+        return tuple(all_features)
 
     def features_as_dict(features, timestamps, time_bounds, id_):
         d = {'features' : features, 'timestamps' : timestamps, 'time_ranges' : time_bounds, 'id' : id_}
@@ -114,6 +118,5 @@ def predict_input_fn(paths,
     return (raw_data
                 .map(xform, num_parallel_calls=parallelism)
                 .flat_map(feature_generation.flatten_features)
-                .map(set_shapes)
                 .map(features_as_dict)
            )
\ No newline at end of file
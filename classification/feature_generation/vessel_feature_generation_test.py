@@ -28,10 +28,13 @@ def test_input_fn():
                         mdl.min_viable_timeslice_length,
                         objectives=mdl.training_objectives,
                         parallelism=1)
-    iterator = input_fn.make_one_shot_iterator()
+    # The dataset looks ids up in hash tables, which a one shot iterator
+    # can't initialize.
+    iterator = input_fn.make_initializable_iterator()
     next_element = iterator.get_next()
     vals = []
     with tf.compat.v1.Session() as sess:
+        sess.run([tf.compat.v1.tables_initializer(), iterator.initializer])
         for _ in range(3):
             x = sess.run(next_element)
             vals.append(x)
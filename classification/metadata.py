@@ -12,21 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict, namedtuple
+import calendar
+from collections import Counter, defaultdict, namedtuple
 import csv
 import datetime
 import dateutil.parser
 import pytz
 import logging
 import os
+import re
 import sys
-import tensorflow as tf
 import yaml
 import numpy as np
 import hashlib
 import six
 from .feature_generation.file_iterator import GCSFile
 
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
 
 """ The main column for vessel classification. """
 PRIMARY_VESSEL_CLASS_COLUMN = 'label'
@@ -128,31 +134,35 @@ FishingRange = namedtuple('FishingRange',
 
 
 def stable_hash(x):
-    x = six.ensure_binary(x)
-    digest = hashlib.blake2b(six.ensure_binary(x)).hexdigest()[-8:]
-    return int(digest, 16)
+    """Hash an id to the int64 value stored as 'id' in the feature files.
+
+    This is the low 32 bits of the blake2b digest, so it must stay in step
+    with the feature generation pipeline.
+    """
+    digest = hashlib.blake2b(six.ensure_binary(x)).digest()
+    return int.from_bytes(digest[-4:], 'big')
 
 class VesselMetadata(object):
     def __init__(self,
                  metadata_dict,
                  fishing_ranges_map):
         self.metadata_by_split = metadata_dict
-        self.metadata_by_id = {}
         self.fishing_ranges_map = fishing_ranges_map
-        self.id_map_int2bytes = {}
-        for split, vessels in metadata_dict.items():
-            for id_, data in vessels.items():
-                id_ = six.ensure_binary(id_)
-                self.metadata_by_id[id_] = data
-                idhash = stable_hash(id_)
-                self.id_map_int2bytes[idhash] = id_
-
-        intersection_ids = set(self.metadata_by_id.keys()).intersection(
-            set(fishing_ranges_map.keys()))
+        self._fishing_range_arrays = None
+        self.metadata_by_id = {six.ensure_binary(id_): data
+                               for vessels in metadata_dict.values()
+                               for id_, data in vessels.items()}
+        self.id_map_int2bytes = {stable_hash(id_): id_
+                                 for id_ in self.metadata_by_id}
+
         logging.info("Metadata for %d ids.", len(self.metadata_by_id))
         logging.info("Fishing ranges for %d ids.", len(fishing_ranges_map))
-        logging.info("Vessels with both types of data: %d",
-                     len(intersection_ids))
+        # Only build the intersection if it's going to be logged.
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            intersection_ids = (self.metadata_by_id.keys() &
+                                fishing_ranges_map.keys())
+            logging.info("Vessels with both types of data: %d",
+                         len(intersection_ids))
 
     def vessel_weight(self, id_):
         return self.metadata_by_id[id_][1]
@@ -160,11 +170,43 @@ class VesselMetadata(object):
     def vessel_label(self, label_name, id_):
         return self.metadata_by_id[id_][0][label_name]
 
+    def iter_labels(self, label_name):
+        """Yield (id_, label) for every vessel we have metadata for."""
+        for id_, (row, _) in self.metadata_by_id.items():
+            yield id_, row[label_name]
+
+    def fishing_range_arrays(self):
+        """Fishing ranges as arrays, sorted by start time.
+
+        Returns:
+            A dict mapping id to a tuple of (starts, ends, is_fishing, order)
+            numpy arrays, with times in seconds from the Unix epoch and order
+            holding each range's position in the fishing ranges file, which
+            decides the label where ranges overlap. Ids without
+            any ranges are omitted. This is computed once and reused by every
+            input function built from this metadata.
+        """
+        if self._fishing_range_arrays is None:
+            self._fishing_range_arrays = {}
+            for id_, ranges in self.fishing_ranges_map.items():
+                if not ranges:
+                    continue
+                starts = np.array([calendar.timegm(x.start_time.utctimetuple())
+                                   for x in ranges], dtype=np.int64)
+                ends = np.array([calendar.timegm(x.end_time.utctimetuple())
+                                 for x in ranges], dtype=np.int64)
+                is_fishing = np.array([x.is_fishing for x in ranges],
+                                      dtype=np.float32)
+                order = np.argsort(starts, kind='stable')
+                self._fishing_range_arrays[id_] = (
+                    starts[order], ends[order], is_fishing[order], order)
+        return self._fishing_range_arrays
+
     def ids_for_split(self, split):
         assert split in (TRAINING_SPLIT, TEST_SPLIT)
         # Check to make sure we don't have leakage
-        if (set(self.metadata_by_split[TRAINING_SPLIT].keys()) &
-            set(self.metadata_by_split[TEST_SPLIT].keys())):
+        if (self.metadata_by_split[TRAINING_SPLIT].keys() &
+            self.metadata_by_split[TEST_SPLIT].keys()):
                     logging.warning('id in both training and test split')
         return self.metadata_by_split[split].keys()
 
@@ -174,20 +216,19 @@ class VesselMetadata(object):
                                max_replication_factor,
                                row_filter=lambda row: True,
                                boundary=1):
-        replicated_ids = []
         logging.info("Training ids: %d", len(self.ids_for_split(split)))
-        fishing_ranges_ids = []
-        for id_, (row, weight) in self.metadata_by_split[split].items():
-            if row_filter(row):
-                if id_ in self.fishing_ranges_map:
-                    fishing_ranges_ids.append(id_)
-                weight = min(weight, max_replication_factor)
-
-                int_n = int(weight)
-                replicated_ids += ([id_] * int_n)
-                frac_n = weight - float(int_n)
-                if (random_state.uniform(0.0, 1.0) <= frac_n):
-                    replicated_ids.append(id_)
+        items = [(id_, weight)
+                 for id_, (row, weight) in self.metadata_by_split[split].items()
+                 if row_filter(row)]
+        ids = np.array([id_ for (id_, _) in items])
+        weights = np.minimum(
+            np.array([w for (_, w) in items], dtype=np.float64),
+            max_replication_factor)
+        # Each id appears int(weight) times, plus once more with probability
+        # equal to the fractional part of its weight.
+        int_n = weights.astype(np.int64)
+        extra = random_state.uniform(0.0, 1.0, size=len(weights)) <= weights - int_n
+        replicated_ids = np.repeat(ids, int_n + extra)
         missing = (-len(replicated_ids)) % boundary
         if missing:
             replicated_ids = np.concatenate(
@@ -195,20 +236,18 @@ class VesselMetadata(object):
                  np.random.choice(replicated_ids, missing)])
         random_state.shuffle(replicated_ids)
         logging.info("Replicated training ids: %d", len(replicated_ids))
-        logging.info("Fishing range ids: %d", len(fishing_ranges_ids))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Fishing range ids: %d",
+                         sum(id_ in self.fishing_ranges_map for id_ in ids))
 
         return replicated_ids
 
     def fishing_range_only_list(self, random_state, split):
-        replicated_ids = []
-        fishing_id_set = set(
-            [k for (k, v) in self.fishing_ranges_map.items() if v])
-        fishing_range_only_ids = [id_
-                                    for id_ in self.ids_for_split(split)
-                                    if id_ in fishing_id_set]
+        split_ids = self.ids_for_split(split)
+        fishing_range_only_ids = [id_ for id_ in split_ids
+                                  if self.fishing_ranges_map.get(id_)]
         logging.info("Fishing range training ids: %d / %d",
-                     len(fishing_range_only_ids),
-                     len(self.ids_for_split(split)))
+                     len(fishing_range_only_ids), len(split_ids))
 
         return fishing_range_only_ids
 
@@ -231,12 +270,17 @@ def read_vessel_time_weighted_metadata_lines(available_ids, lines,
 
     metadata_dict = {TRAINING_SPLIT : {}, TEST_SPLIT : {}}
 
+    # Weights are normalized by the smallest nonzero time, which isn't known
+    # until every row is read, so collect (split, id, row, time) first.
+    entries = []
     min_time_per_id = np.inf
 
+    available_ids = frozenset(available_ids)
     for row in lines:
-        id_ = six.ensure_binary(row['id'].strip())
+        id_ = row['id'].strip().encode('utf-8')
         if id_ in available_ids:
-            if id_ not in fishing_range_dict:
+            ranges = fishing_range_dict.get(id_)
+            if ranges is None:
                 continue
             # Is this id included only to supress false positives
             # Symptoms; fishing score for this id never different from 0
@@ -251,14 +295,12 @@ def read_vessel_time_weighted_metadata_lines(available_ids, lines,
                     'id %s has no valid split assigned (%s); using for Training',
                     id_, split)
                 split = TRAINING_SPLIT
-            time_for_this_id = 0
-            for rng in fishing_range_dict[id_]:
-                time_for_this_id += (
-                    rng.end_time - rng.start_time).total_seconds()
-            metadata_dict[item_split][id_] = (row, time_for_this_id)
+            time_for_this_id = sum([(rng.end_time - rng.start_time).total_seconds()
+                                    for rng in ranges])
+            entries.append((item_split, id_, row, time_for_this_id))
             if split is None and raw_item_split in '0123456789':
                 # Test on everything even though we are training on everything
-                metadata_dict[TEST_SPLIT][id_] = (row, time_for_this_id)
+                entries.append((TEST_SPLIT, id_, row, time_for_this_id))
 
             if time_for_this_id:
                 min_time_per_id = min(min_time_per_id, time_for_this_id)
@@ -266,10 +308,9 @@ def read_vessel_time_weighted_metadata_lines(available_ids, lines,
     # This weighting is fiddly. We are keeping it for now to match up
     # with older data, but should replace when we move to sets, etc.
     MAX_WEIGHT = 100.0
-    for split_dict in metadata_dict.values():
-        for id_ in split_dict:
-            row, time = split_dict[id_]
-            split_dict[id_] = (row, min(MAX_WEIGHT, time / min_time_per_id))
+    for item_split, id_, row, time in entries:
+        metadata_dict[item_split][id_] = (row,
+                                          min(MAX_WEIGHT, time / min_time_per_id))
 
     return VesselMetadata(metadata_dict, fishing_range_dict)
 
@@ -301,26 +342,33 @@ def read_vessel_multiclass_metadata_lines(available_ids, lines,
     """
 
     vessel_type_set = set()
-    dataset_kind_counts = defaultdict(lambda: defaultdict(lambda: 0))
+    dataset_kind_counts = defaultdict(Counter)
     vessel_types = []
 
     cat_map = {k: v for (k, v) in VESSEL_CATEGORIES}
 
-    available_ids = set(available_ids)
+    # Many vessels share the same label string, so resolve each distinct
+    # label to its atomic types (and later its weight) only once.
+    atomic_types_by_label = {}
+
+    available_ids = frozenset(available_ids)
     for row in lines:
-        id_ = six.ensure_binary(row['id'].strip())
+        id_ = row['id'].strip().encode('utf-8')
         if id_ not in available_ids:
             continue
         raw_vessel_type = row[PRIMARY_VESSEL_CLASS_COLUMN]
         if not raw_vessel_type:
             continue
-        atomic_types = set()
-        for kind in raw_vessel_type.split('|'):
-            try:
-                for atm in cat_map[kind]:
-                    atomic_types.add(atm)
-            except StandardError as err:
-                logging.warning('unknown vessel type: {}\n{}'.format(kind, err))
+        atomic_types = atomic_types_by_label.get(raw_vessel_type)
+        if atomic_types is None:
+            atomic_types = set()
+            for kind in raw_vessel_type.split('|'):
+                try:
+                    for atm in cat_map[kind]:
+                        atomic_types.add(atm)
+                except KeyError:
+                    logging.warning('unknown vessel type: %s', kind)
+            atomic_types_by_label[raw_vessel_type] = atomic_types
         if not atomic_types:
             continue
         scale = 1.0 / len(atomic_types)
@@ -336,24 +384,29 @@ def read_vessel_multiclass_metadata_lines(available_ids, lines,
 
     # # Calculate weights for each vessel type per split, for
     # # now use weights of sqrt(max_count / count)
-    dataset_kind_weights = defaultdict(lambda: {})
+    dataset_kind_weights = {}
     for split, counts in dataset_kind_counts.items():
-        max_count = max(counts.values())
-        for atomic_vessel_type, count in counts.items():
-            dataset_kind_weights[split][atomic_vessel_type] = np.sqrt(max_count / float(count))
+        kinds = list(counts)
+        count_array = np.array([counts[k] for k in kinds], dtype=np.float64)
+        weights = np.sqrt(count_array.max() / count_array)
+        dataset_kind_weights[split] = dict(zip(kinds, weights.tolist()))
 
-    metadata_dict = defaultdict(lambda: {})
+    training_weight_by_label = {}
+    metadata_dict = defaultdict(dict)
     for id_, split, raw_vessel_type, row in vessel_types:
         if split == 'Training':
-            weights = []
-            for kind in raw_vessel_type.split('|'):
-                for atm in cat_map.get(kind, 'unknown'):
-                    weights.append(dataset_kind_weights[split][atm])
-            metadata_dict[split][id_] = (row, np.mean(weights))
+            if raw_vessel_type not in training_weight_by_label:
+                weights = []
+                for kind in raw_vessel_type.split('|'):
+                    for atm in cat_map.get(kind, 'unknown'):
+                        weights.append(dataset_kind_weights[split][atm])
+                training_weight_by_label[raw_vessel_type] = np.mean(weights)
+            metadata_dict[split][id_] = (row,
+                                         training_weight_by_label[raw_vessel_type])
         elif split == "Test":
             metadata_dict[split][id_] = (row, 1.0)
         else:
-            logging.warning("unknown split {}".format(split))
+            logging.warning("unknown split %s", split)
 
     if len(vessel_type_set) == 0:
         logging.fatal('No vessel types found for training.')
@@ -366,15 +419,30 @@ def read_vessel_multiclass_metadata_lines(available_ids, lines,
 
 
 def metadata_file_reader(metadata_file):
-    """
-
+    """ Yield each row of a metadata CSV as a dict of column name to value.
 
+    Labels may come from any column, so every column is kept, but the rows are
+    built with a single zip against the header rather than via DictReader.
+    Ragged rows are handled the same way DictReader handles them: missing
+    columns are None and any extra values are listed under the None key.
     """
-    with open(metadata_file, 'r') as f:
-        reader = csv.DictReader(f)
-        logging.info("Metadata columns: %s", reader.fieldnames)
+    # newline='' is what the csv module expects, and a large buffer cuts the
+    # number of reads for big metadata files.
+    with open(metadata_file, 'r', buffering=1 << 20, newline='') as f:
+        reader = csv.reader(f)
+        fieldnames = next(reader, [])
+        logging.info("Metadata columns: %s", fieldnames)
+        width = len(fieldnames)
         for row in reader:
-            yield row
+            if len(row) == width:
+                yield dict(zip(fieldnames, row))
+            elif row:
+                d = dict(zip(fieldnames, row))
+                if len(row) < width:
+                    d.update(dict.fromkeys(fieldnames[len(row):]))
+                else:
+                    d[None] = row[width:]
+                yield d
 
 
 def read_vessel_multiclass_metadata(available_ids,
@@ -387,19 +455,19 @@ def read_vessel_multiclass_metadata(available_ids,
 
 
 def find_available_ids(feature_path):
-    with tf.Session() as sess:
-        logging.info('Reading id list file.')
-        root_output_path = os.path.dirname(feature_path)
-        # The feature pipeline stage that outputs the id list is sharded to only
-        # produce a single file, so no need to glob or loop here.
-        id_path = os.path.join(root_output_path, 'ids/part-00000-of-00001.txt')
-        logging.info('Reading id list file from {}'.format(id_path))
-        with GCSFile(id_path) as f:
-            els = f.read().split(b'\n')
-        id_list = [id_.strip() for id_ in els if id_.strip() != '']
+    # This is plain file I/O, so there is no need for a tf.Session here.
+    root_output_path = os.path.dirname(feature_path)
+    # The feature pipeline stage that outputs the id list is sharded to only
+    # produce a single file, so no need to glob or loop here.
+    id_path = os.path.join(root_output_path, 'ids/part-00000-of-00001.txt')
+    logging.info('Reading id list file from %s', id_path)
+    with GCSFile(id_path) as f:
+        # Splitting on whitespace strips each id and drops blank lines
+        # in a single pass.
+        id_list = f.read().split()
 
-        logging.info('Found %d ids.', len(id_list))
-        return set(id_list)
+    logging.info('Found %d ids.', len(id_list))
+    return set(id_list)
 
 
 def parse_date(date):
@@ -408,6 +476,12 @@ def parse_date(date):
         return datetime.datetime.utcfromtimestamp(unix_timestamp).replace(
             tzinfo=pytz.utc)
     except:
+        if ciso8601 is not None:
+            # Much faster than dateutil for the ISO 8601 times we usually see.
+            try:
+                return ciso8601.parse_datetime(date)
+            except ValueError:
+                pass
         try:
             return dateutil.parser.parse(date)
         except:
@@ -415,20 +489,41 @@ def parse_date(date):
             raise
 
 
+# Whole-second ISO 8601 UTC times, which numpy can parse in bulk.
+_ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}:\d{2})?Z?$')
+
+
+def parse_dates(dates):
+    """ Parse a sequence of date strings to a list of UTC datetimes.
+
+    Columns of plain ISO 8601 times are parsed in one pass by numpy; anything
+    else falls back to `parse_date` for each value.
+    """
+    dates = [x.strip() for x in dates]
+    if all(_ISO_DATETIME.match(x) for x in dates):
+        parsed = np.array([x.rstrip('Z') for x in dates], dtype='datetime64[s]')
+        parsed = parsed.astype(datetime.datetime).tolist()
+    else:
+        parsed = [parse_date(x) for x in dates]
+    return [x.replace(tzinfo=pytz.utc) for x in parsed]
+
+
 def read_fishing_ranges(fishing_range_file):
     """ Read vessel fishing ranges, return a dict of id to classified fishing
         or non-fishing ranges for that vessel.
     """
-    fishing_range_dict = defaultdict(lambda: [])
-    with open(fishing_range_file, 'r') as f:
-        for l in f.readlines()[1:]:
-            els = l.split(',')
-            id_ = six.ensure_binary(els[0].strip())
-            start_time = parse_date(els[1]).replace(tzinfo=pytz.utc)
-            end_time = parse_date(els[2]).replace(tzinfo=pytz.utc)
-            is_fishing = float(els[3])
-            fishing_range_dict[id_].append(
-                FishingRange(start_time, end_time, is_fishing))
+    with open(fishing_range_file, 'r', buffering=1 << 20) as f:
+        next(f, None)
+        rows = [l.split(',') for l in f]
+    start_times = parse_dates([els[1] for els in rows])
+    end_times = parse_dates([els[2] for els in rows])
+
+    fishing_range_dict = defaultdict(list)
+    for els, start_time, end_time in zip(rows, start_times, end_times):
+        id_ = els[0].strip().encode('utf-8')
+        is_fishing = float(els[3])
+        fishing_range_dict[id_].append(
+            FishingRange(start_time, end_time, is_fishing))
 
     return dict(fishing_range_dict)
 
@@ -436,28 +531,14 @@ def read_fishing_ranges(fishing_range_file):
 def build_multihot_lookup_table():
     n_base = len(VESSEL_CLASS_DETAILED_NAMES)
     n_categories = len(VESSEL_CATEGORIES)
-    #
+    base_index = {lbl: j for (j, lbl) in enumerate(VESSEL_CLASS_DETAILED_NAMES)}
+    rows = [i for (i, (_, base_labels)) in enumerate(VESSEL_CATEGORIES)
+              for _ in base_labels]
+    cols = [base_index[lbl] for (_, base_labels) in VESSEL_CATEGORIES
+                            for lbl in base_labels]
     table = np.zeros([n_categories, n_base], dtype=np.int32)
-    for i, (_, base_labels) in enumerate(VESSEL_CATEGORIES):
-        for lbl in base_labels:
-            j = VESSEL_CLASS_DETAILED_NAMES.index(lbl)
-            table[i, j] = 1
+    table[rows, cols] = 1
     return table
 
 
 multihot_lookup_table = build_multihot_lookup_table()
-
-
-def multihot_encode(label):
-    """Multihot encode based on fine, coarse and is_fishing label
-
-    Args:
-        label: Tensor (int)
-
-    Returns:
-        Tensor with bits set for every allowable vessel type based on the inputs
-
-
-    """
-    tf_multihot_lookup_table = tf.convert_to_tensor(multihot_lookup_table)
-    return tf.gather(tf_multihot_lookup_table, label)
@@ -18,7 +18,9 @@ import numpy as np
 from . import metadata
 import tensorflow as tf
 from datetime import datetime
+import pytz
 import six
+from unittest import mock
 
 
 class VesselMetadataFileReaderTest(tf.test.TestCase):
@@ -82,6 +84,28 @@ class VesselMetadataFileReaderTest(tf.test.TestCase):
 
         self._check_splits(result)
 
+    def test_metadata_file_reader_ragged_rows(self):
+        path = os.path.join(self.get_temp_dir(), 'ragged.csv')
+        with open(path, 'w') as f:
+            f.write('id,label,length\n100001,trawlers\n100002,tug,5.0,extra\n')
+        with open(path, newline='') as f:
+            expected = list(csv.DictReader(f))
+        rows = list(metadata.metadata_file_reader(path))
+        self.assertEqual(expected, rows)
+        self.assertEqual(None, rows[0]['length'])
+        self.assertEqual(['extra'], rows[1][None])
+
+    def test_iter_labels(self):
+        parsed_lines = csv.DictReader(self.raw_lines)
+        available_vessels = set(six.ensure_binary(str(x)) for x in range(100001, 100014))
+        result = metadata.read_vessel_multiclass_metadata_lines(
+            available_vessels, parsed_lines, {})
+
+        labels = dict(result.iter_labels('label'))
+        self.assertEqual(len(result.metadata_by_id), len(labels))
+        self.assertEqual('passenger', labels[b'100007'])
+        self.assertEqual('tug|trawlers', labels[b'100013'])
+
     def test_fixed_time_reader(self):
         parsed_lines = csv.DictReader(self.raw_lines)
         available_vessels = set(six.ensure_binary(str(x)) for x in range(100001, 100014))
@@ -96,6 +120,54 @@ class VesselMetadataFileReaderTest(tf.test.TestCase):
 
         self._check_splits(result)
 
+    def test_fishing_range_arrays(self):
+        result = metadata.VesselMetadata({}, self.fishing_range_dict)
+        arrays = result.fishing_range_arrays()
+        self.assertEqual(set(arrays), set(k for (k, v) in
+                                          self.fishing_range_dict.items() if v))
+        starts, ends, is_fishing, order = arrays[b'100009']
+        self.assertEqual([1425168000], starts.tolist())
+        self.assertEqual([1425427200], ends.tolist())
+        self.assertEqual([1.0], is_fishing.tolist())
+        self.assertEqual([0], order.tolist())
+        self.assertIs(arrays, result.fishing_range_arrays())
+        # Ranges are sorted by start, but keep their position in the file.
+        result = metadata.VesselMetadata({}, {b'100001': [
+            metadata.FishingRange(datetime(2015, 3, 2), datetime(2015, 3, 3), 0.0),
+            metadata.FishingRange(datetime(2015, 3, 1), datetime(2015, 3, 4), 1.0)]})
+        starts, ends, is_fishing, order = result.fishing_range_arrays()[b'100001']
+        self.assertEqual([1425168000, 1425254400], starts.tolist())
+        self.assertEqual([1.0, 0.0], is_fishing.tolist())
+        self.assertEqual([1, 0], order.tolist())
+
+    def test_parse_dates(self):
+        utc = pytz.utc
+        self.assertEqual(
+            [datetime(2014, 6, 6, 1, 37, 5, tzinfo=utc),
+             datetime(2015, 3, 1, tzinfo=utc)],
+            metadata.parse_dates(['2014-06-06T01:37:05Z', '2015-03-01']))
+        # Anything numpy can't parse exactly goes through parse_date.
+        self.assertEqual(
+            [datetime(2015, 3, 1, tzinfo=utc),
+             datetime(2015, 3, 1, 0, 0, 0, 500000, tzinfo=utc)],
+            metadata.parse_dates(['1425168000', '2015-03-01T00:00:00.5Z']))
+
+    def test_parse_date(self):
+        utc = pytz.utc
+        cases = [('1425168000', datetime(2015, 3, 1, tzinfo=utc)),
+                 ('2014-06-06T01:37:05Z', datetime(2014, 6, 6, 1, 37, 5, tzinfo=utc)),
+                 ('2015-03-01T00:00:00.5Z',
+                  datetime(2015, 3, 1, 0, 0, 0, 500000, tzinfo=utc)),
+                 ('2015-03-01 12:00:00+00:00', datetime(2015, 3, 1, 12, tzinfo=utc))]
+        # Check the dateutil fallback as well as ciso8601, if it is installed.
+        for ciso8601 in set([metadata.ciso8601, None]):
+            with mock.patch.object(metadata, 'ciso8601', ciso8601):
+                for date, expected in cases:
+                    self.assertEqual(expected, metadata.parse_date(date))
+                # dateutil handles formats that aren't ISO 8601.
+                self.assertEqual(datetime(2015, 3, 1),
+                                 metadata.parse_date('March 1 2015'))
+
     def _check_splits(self, result):
 
         self.assertTrue('Training' in result.metadata_by_split)
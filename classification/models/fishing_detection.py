@@ -20,11 +20,11 @@ from . import layers
 from classification import metadata
 from .objectives import (
     FishingLocalizationObjectiveCrossEntropy, TrainNetInfo)
+from classification.feature_generation import feature_generation
 from classification.feature_generation import fishing_feature_generation
 import logging
 import math
 import numpy as np
-import six
 import os
 
 import tensorflow as tf
@@ -95,10 +95,7 @@ class Model(ModelBase):
         random_state = np.random.RandomState()
         training_ids = self.vessel_metadata.fishing_range_only_list(
             random_state, split)
-        return [
-            '%s/%s.tfrecord' % (base_feature_path, six.ensure_text(id_))
-            for id_ in training_ids
-        ]
+        return self.feature_file_paths(base_feature_path, training_ids)
 
     def _build_net(self, features, timestamps, ids, is_training):
         layers.misconception_fishing(
@@ -134,7 +131,8 @@ class Model(ModelBase):
 
             global_step = tf.train.get_global_step()
 
-            total_loss = self.fishing_localisation_objective.create_loss(labels)
+            loss = self.fishing_localisation_objective.build_loss(labels)
+            total_loss = self.fishing_localisation_objective.create_weighted_loss(loss)
 
             learning_rate = tf.train.exponential_decay(
                 self.initial_learning_rate, global_step, 
@@ -153,7 +151,7 @@ class Model(ModelBase):
 
             assert mode == tf.estimator.ModeKeys.EVAL
 
-            eval_metrics = self.fishing_localisation_objective.create_metrics(labels)
+            eval_metrics = self.fishing_localisation_objective.create_metrics(labels, loss)
 
             return tf.estimator.EstimatorSpec(
               mode=mode,
@@ -176,18 +174,16 @@ class Model(ModelBase):
 
     def make_input_fn(self, base_feature_path, split, parallelism, prefetch):
         def input_fn():
-            return (fishing_feature_generation.input_fn(
-                        self.vessel_metadata,
-                        self.build_training_file_list(base_feature_path, split),
-                        self.num_feature_dimensions + 1,
-                        self.max_window_duration_seconds,
-                        self.window_max_points,
-                        self.min_viable_timeslice_length,
-                        parallelism=parallelism)
-                .prefetch(prefetch)
-                .shuffle(prefetch)
-                .batch(self.batch_size)
-                )
+            return feature_generation.batch_training_dataset(
+                    fishing_feature_generation.input_fn(
+                            self.vessel_metadata,
+                            self.build_training_file_list(base_feature_path, split),
+                            self.num_feature_dimensions + 1,
+                            self.max_window_duration_seconds,
+                            self.window_max_points,
+                            self.min_viable_timeslice_length,
+                            parallelism=parallelism),
+                    self.batch_size, prefetch)
         return input_fn
 
     def make_training_input_fn(self, base_feature_path, num_parallel_reads, prefetch=1024):
@@ -199,14 +195,15 @@ class Model(ModelBase):
     def make_prediction_input_fn(self, paths, range_info, parallelism):
         start_date, end_date = range_info
         def input_fn():
-            return fishing_feature_generation.predict_input_fn(
+            return feature_generation.batch_prediction_dataset(
+                    fishing_feature_generation.predict_input_fn(
                             paths,
                             self.num_feature_dimensions + 1,
                             self.window_max_points,
                             start_date,
                             end_date,
                             self.window,
-                            parallelism=parallelism
-                    ).batch(1)
+                            parallelism=parallelism),
+                    self.prediction_batch_size)
         return input_fn
 
@@ -31,7 +31,7 @@ def zero_pad_features(features, depth):
 
 def repeat_tensor(input, n):
     batch_size, width, depth = input.get_shape()
-    repeated = tf.concat([input] * n, 2)
+    repeated = tf.tile(input, [1, 1, n])
     return tf.reshape(repeated, [-1, int(width) * n, int(depth)])
 
 
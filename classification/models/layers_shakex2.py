@@ -32,7 +32,7 @@ def zero_pad_features(features, depth):
 
 def repeat_tensor(input, n):
     batch_size, width, depth = input.get_shape()
-    repeated = tf.concat([input] * n, 2)
+    repeated = tf.tile(input, [1, 1, n])
     return tf.reshape(repeated, [-1, int(width) * n, int(depth)])
 
 
@@ -134,28 +134,6 @@ def shake2_with_max(inputs,
         return y
 
 
-def shake2_with_bypass(inputs,
-                              filters,
-                              kernel_size,
-                              stride,
-                              training,
-                              scope=None):
-
-    with tf.name_scope(scope):
-
-        residual = shake2(inputs, filters, kernel_size, stride, training)
-
-        # crop = (kernel_size - stride // 2) // 2 # TODO: work this out more generally / cleanly
-        crop = kernel_size // 2 
-        thru = inputs
-        if crop:
-            thru = inputs[:, crop:-crop]
-        thru = thru[:, ::stride]
-        thru = zero_pad_features(thru, filters)
-
-        return thru + residual
-
-
 def shakeout2_with_bypass(inputs,
                               filters,
                               kernel_size,
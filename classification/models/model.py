@@ -35,6 +35,11 @@ class ModelBase(object):
     def batch_size(self):
         return 64
 
+    @property
+    def prediction_batch_size(self):
+        """Number of windows run through the network per inference step"""
+        return 32
+
     @property
     def max_window_duration_seconds(self):
         """ Window max duration in seconds. A value of zero indicates that
@@ -66,6 +71,22 @@ class ModelBase(object):
             self.fishing_ranges_map = None
         self.training_objectives = None
 
+    @staticmethod
+    def feature_file_paths(base_feature_path, ids):
+        """Return the feature file path for each id as a numpy string array."""
+        ids = np.asarray(ids)
+        if len(ids) == 0:
+            return np.array([], dtype=str)
+        if ids.dtype.kind == 'S':
+            ids = np.char.decode(ids, 'utf-8')
+        elif ids.dtype.kind == 'O':
+            # Mixed or bytes objects, formatted as the old '%s' paths were.
+            ids = np.array([six.ensure_text(x) if isinstance(x, bytes) else str(x)
+                            for x in ids])
+        elif ids.dtype.kind != 'U':
+            ids = ids.astype(str)
+        return np.char.add(np.char.add(base_feature_path + '/', ids), '.tfrecord')
+
     def build_training_file_list(self, base_feature_path, split):
         boundary = 1 if (split == metadata.TRAINING_SPLIT) else self.batch_size
         random_state = np.random.RandomState()
@@ -74,10 +95,7 @@ class ModelBase(object):
             split,
             self.max_replication_factor,
             boundary=boundary)
-        return [
-            '%s/%s.tfrecord' % (base_feature_path, six.ensure_text(id_))
-            for id_ in training_ids
-        ]
+        return self.feature_file_paths(base_feature_path, training_ids)
 
     @staticmethod
     def read_metadata(all_available_ids,
@@ -35,6 +35,20 @@ class ModelsTest(tf.test.TestCase):
                 with tf.variable_scope("training-test-{}".format(i)):
                     est = self._build_estimator(model_class)
 
+    def test_feature_file_paths(self):
+        expected = ['gs://features/416853000.tfrecord',
+                    'gs://features/204248000.tfrecord']
+        for ids in [[416853000, 204248000],
+                    ['416853000', '204248000'],
+                    [b'416853000', b'204248000'],
+                    np.array([b'416853000', b'204248000'], dtype=object),
+                    np.array([416853000, 204248000], dtype=np.int64)]:
+            paths = vessel_characterization.Model.feature_file_paths(
+                                                    'gs://features', ids)
+            self.assertEqual(expected, paths.tolist())
+        self.assertEqual([], vessel_characterization.Model.feature_file_paths(
+                                                    'gs://features', []).tolist())
+
     # TODO: test input_fn
 
 
@@ -15,14 +15,12 @@
 import abc
 import calendar
 from collections import namedtuple, OrderedDict
-import datetime
 import logging
 import numpy as np
 import tensorflow as tf
 import tensorflow.metrics as metrics
 from classification import metadata
 import pytz
-import six
 """ Terminology in the context of objectives.
     
     Net: the raw input to an objective function, an embeddeding that has not
@@ -46,9 +44,30 @@ def f1(recall, precision):
     return (f1, f1)
 
 
+def precision_and_recall(labels, predictions, weights):
+    """Streaming precision and recall that share one true positive count.
+
+    Equivalent to tf.metrics.precision / tf.metrics.recall, but three
+    counters are accumulated instead of four.
+    """
+    tp, tp_update = tf.metrics.true_positives(labels, predictions, weights=weights)
+    fp, fp_update = tf.metrics.false_positives(labels, predictions, weights=weights)
+    fn, fn_update = tf.metrics.false_negatives(labels, predictions, weights=weights)
+    precision = (tf.div_no_nan(tp, tp + fp),
+                 tf.div_no_nan(tp_update, tp_update + fp_update))
+    recall = (tf.div_no_nan(tp, tp + fn),
+              tf.div_no_nan(tp_update, tp_update + fn_update))
+    return precision, recall
+
+
 class ObjectiveBase(object):
     __metaclass__ = abc.ABCMeta
 
+    # Compile the loss (and its gradient) with XLA so that the many small
+    # elementwise ops fuse into a few kernels. Off by default because not
+    # every training runtime ships XLA kernels for the ops we use.
+    jit_loss = False
+
     def __init__(self, metadata_label, name, loss_weight, metrics):
         """
         args:
@@ -68,15 +87,33 @@ class ObjectiveBase(object):
     def build(self, net):
         pass
 
-    def create_metrics(self, labels):
-        raw_metrics = self.create_raw_metrics(labels)
+    def build_loss(self, labels):
+        """Return this objective's unweighted loss.
+
+        Models build the loss once and pass it to both `create_weighted_loss`
+        and `create_metrics`, so training and eval share one loss subgraph.
+        """
+        if self.jit_loss:
+            with tf.contrib.compiler.jit.experimental_jit_scope():
+                return self.create_loss(labels)
+        return self.create_loss(labels)
+
+    def create_weighted_loss(self, loss):
+        """Return a loss from `build_loss` scaled by this objective's loss_weight.
+
+        Models sum the weighted losses with a single tf.add_n.
+        """
+        return self.loss_weight * loss
+
+    def create_metrics(self, labels, loss):
+        raw_metrics = self.create_raw_metrics(labels, loss)
         try:
             eval_metrics = {"{}/{}".format(self.name, k) : v for (k, v) in raw_metrics.items()}
         except:
             logging.warning("Problem creating eval_metrics in {}".format(self))
             return {}
-        for k, v in eval_metrics.items():
-            tf.summary.scalar(k, v[1])
+        # No per-metric tf.summary ops: the Estimator writes the final value
+        # of every eval_metric_op to the eval summaries itself.
         return eval_metrics
 
 
@@ -94,33 +131,25 @@ class RegressionObjective(ObjectiveBase):
         self.output_shape = []
 
     def create_label(self, id_, timestamps):
-        self.value_from_id(id_)
+        return self.value_from_id(id_)
 
     def build(self, net):
         self.prediction = tf.layers.dense(net, 1, activation=None)[:, 0]
 
-    def expected_and_mask(self, labels):
-        mask = ~tf.is_nan(labels)
-        valid = tf.boolean_mask(labels, mask)
-        idx = tf.to_int32(tf.where(mask))
-        expected = tf.scatter_nd(idx, valid, tf.shape(labels))
-        return expected, mask
+    def labelled(self, labels):
+        """Return the expected values and predictions for labelled examples only."""
+        valid = ~tf.is_nan(labels)
+        return tf.boolean_mask(labels, valid), tf.boolean_mask(self.prediction, valid)
 
     def masked_mean_error(self, labels):
-        expected, mask = self.expected_and_mask(labels)
-        mask = tf.cast(mask, tf.float32)
-        count = tf.reduce_sum(mask)
-        diff = tf.abs((expected - self.prediction) * mask)
-        error = tf.reduce_sum(diff) / tf.maximum(count, EPSILON)
-        return error
+        expected, prediction = self.labelled(labels)
+        return tf.losses.absolute_difference(expected, prediction,
+                                             loss_collection=None)
 
     def create_loss(self, labels):
-        raw_loss = self._masked_mean_error(self.prediction, ids)
-        return raw_loss * self.loss_weight
+        return self.masked_mean_error(labels)
 
-    def create_raw_metrics(self, labels):
-        error = self.masked_mean_error(labels)
-        loss = self.masked_mean_loss(self.prediction)
+    def create_raw_metrics(self, labels, loss):
         return {
             'loss' : tf.metrics.mean(loss),
         }
@@ -145,37 +174,25 @@ class LogRegressionObjective(ObjectiveBase):
     def build(self, net):
         self.prediction = tf.layers.dense(net, 1, activation=None)[:, 0]
 
-    def expected_and_mask(self, labels):
-        mask = ~tf.is_nan(labels)
-        valid = tf.boolean_mask(labels, mask)
-        idx = tf.to_int32(tf.where(mask))
-        expected = tf.scatter_nd(idx, valid, tf.shape(labels))
-        return expected, mask
+    def labelled(self, labels):
+        """Return the expected values and predictions for labelled examples only."""
+        valid = ~tf.is_nan(labels)
+        return tf.boolean_mask(labels, valid), tf.boolean_mask(self.prediction, valid)
 
     def masked_mean_loss(self, labels):
-        expected, mask = self.expected_and_mask(labels)
-        mask = tf.cast(mask, tf.float32)
-        count = tf.reduce_sum(mask)
-        squared_error = (
-            (tf.log(expected + EPSILON) - self.prediction)**2 * mask)
-        loss = tf.reduce_sum(squared_error) / tf.maximum(count, EPSILON)
-        return loss
+        expected, prediction = self.labelled(labels)
+        return tf.losses.mean_squared_error(tf.log(expected + EPSILON), prediction,
+                                            loss_collection=None)
 
     def masked_mean_error(self, labels):
-        expected, mask = self.expected_and_mask(labels)
-        mask = tf.cast(mask, tf.float32)
-        count = tf.reduce_sum(mask)
-        diff = tf.abs((expected - tf.exp(self.prediction)) * mask)
-        error = tf.reduce_sum(diff) / tf.maximum(count, EPSILON)
-        return error
+        expected, prediction = self.labelled(labels)
+        return tf.losses.absolute_difference(expected, tf.exp(prediction),
+                                             loss_collection=None)
 
     def create_loss(self, labels):
-        raw_loss = self.masked_mean_loss(labels)
-        print(raw_loss, self.loss_weight)
-        return raw_loss * self.loss_weight
+        return self.masked_mean_loss(labels)
 
-    def create_raw_metrics(self, labels):
-        loss = self.masked_mean_loss(labels)
+    def create_raw_metrics(self, labels, loss):
         error = self.masked_mean_error(labels)
         return {
             'loss': tf.metrics.mean(loss),
@@ -202,13 +219,9 @@ class LogRegressionObjectiveMAE(LogRegressionObjective):
         return self.value_from_id(id_)
 
     def masked_mean_loss(self, labels):
-        expected, mask = self.expected_and_mask(labels)
-        mask = tf.cast(mask, tf.float32)
-        count = tf.reduce_sum(mask)
-        mean_absolute_error = tf.abs(
-            (tf.log(expected + EPSILON) - self.prediction) * mask)
-        loss = tf.reduce_sum(mean_absolute_error) / tf.maximum(count, EPSILON)
-        return loss
+        expected, prediction = self.labelled(labels)
+        return tf.losses.absolute_difference(tf.log(expected + EPSILON), prediction,
+                                             loss_collection=None)
 
 
 
@@ -226,6 +239,12 @@ class MultiClassificationObjective(ObjectiveBase):
         self.num_classes = metadata.multihot_lookup_table.shape[-1]
         self.class_indices = {k[0]: i for (i, k) in enumerate(metadata.VESSEL_CATEGORIES)}
         self.output_shape = [self.num_classes]
+        # Labels only depend on the id, so encode them once up front rather
+        # than parsing the label string for every sample.
+        self._label_table = {}
+        if vessel_metadata is not None:
+            for id_, lbl_str in vessel_metadata.iter_labels('label'):
+                self._label_table[id_] = self._encode_label(lbl_str)
 
 
     def build(self, net):
@@ -233,9 +252,9 @@ class MultiClassificationObjective(ObjectiveBase):
             net, self.num_classes, activation=None)
         self.prediction = tf.nn.softmax(self.logits)
 
-    def create_label(self, id_, timestamps):
+    def _encode_label(self, lbl_str):
         encoded = np.zeros([self.num_classes], dtype=np.int32)
-        lbl_str = self.vessel_metadata.vessel_label('label', id_).strip()
+        lbl_str = lbl_str.strip()
         if lbl_str:
             for lbl in lbl_str.split('|'):
                 j = self.class_indices[lbl]
@@ -243,19 +262,22 @@ class MultiClassificationObjective(ObjectiveBase):
                 encoded |= metadata.multihot_lookup_table[j]
         return encoded.astype(np.float32)
 
+    def create_label(self, id_, timestamps):
+        return self._label_table[id_]
+
     def create_loss(self, labels):
         with tf.variable_scope("custom-loss"):
-            mask = tf.to_float(tf.greater_equal(tf.reduce_sum(labels, axis=1), 1))
-            positives = tf.reduce_sum(
-                tf.to_float(labels) * self.prediction, reduction_indices=[1])
-            raw_loss = -tf.reduce_mean(mask * tf.log(positives + EPSILON))
-        return raw_loss * self.loss_weight
-
-    def create_raw_metrics(self, labels):
-        mask = tf.to_float(tf.equal(tf.reduce_sum(labels, axis=1), 1))
-        encoded_labels = tf.to_int32(tf.argmax(labels, axis=1))
-        predictions = tf.to_int32(tf.argmax(self.prediction, axis=1))
-        loss = self.create_loss(labels)
+            mask = tf.cast(tf.greater_equal(tf.reduce_sum(labels, axis=1), 1),
+                           tf.float32)
+            # Labels arrive as float32 multihot vectors from the input
+            # pipeline, so they can weight the probabilities directly.
+            positives = tf.reduce_sum(labels * self.prediction, axis=1)
+            return -tf.reduce_mean(mask * tf.log(positives + EPSILON))
+
+    def create_raw_metrics(self, labels, loss):
+        mask = tf.cast(tf.equal(tf.reduce_sum(labels, axis=1), 1), tf.float32)
+        encoded_labels = tf.argmax(labels, axis=1, output_type=tf.int32)
+        predictions = tf.argmax(self.prediction, axis=1, output_type=tf.int32)
         return {
             'accuracy' : metrics.accuracy(predictions, encoded_labels, weights=mask),
             'loss' : tf.metrics.mean(loss)
@@ -263,16 +285,14 @@ class MultiClassificationObjective(ObjectiveBase):
 
     def build_json_results(self, class_probabilities, timestamps):
         max_prob_index = np.argmax(class_probabilities)
-        max_probability = float(class_probabilities[max_prob_index])
-        max_label = self.classes[max_prob_index]
-        full_scores = dict(
-            zip(self.classes, [float(v) for v in class_probabilities]))
+        # Convert to Python floats in one call rather than per class.
+        scores = class_probabilities.tolist()
 
         return {
             'name': self.name,
-            'max_label': max_label,
-            'max_label_probability': max_probability,
-            'label_scores': full_scores
+            'max_label': self.classes[max_prob_index],
+            'max_label_probability': scores[max_prob_index],
+            'label_scores': dict(zip(self.classes, scores))
         }
 
 
@@ -291,89 +311,91 @@ class FishingLocalizationObjectiveCrossEntropy(ObjectiveBase):
         self.pos_weight = 1.0
 
     def loss_function(self, dense_labels):
-        fishing_mask = tf.to_float(tf.not_equal(dense_labels, -1))
-        fishing_targets = tf.to_float(dense_labels > 0.5)
         logits = self.logits
         if self.window:
             b, e = self.window
-            fishing_mask = fishing_mask[:, b:e]
-            fishing_targets = fishing_targets[:, b:e]
+            dense_labels = dense_labels[:, b:e]
             logits = logits[:, b:e]
-        return tf.reduce_sum(fishing_mask *
-                             tf.nn.weighted_cross_entropy_with_logits(
-                                 targets=fishing_targets,
-                                 logits=logits,
-                                 pos_weight=self.pos_weight))
+        fishing_mask = tf.cast(tf.not_equal(dense_labels, -1), tf.float32)
+        fishing_targets = tf.cast(dense_labels > 0.5, tf.float32)
+        # For binary targets, scaling the positive terms by pos_weight matches
+        # weighted_cross_entropy_with_logits, so fold it into the weights.
+        weights = fishing_mask
+        if self.pos_weight != 1.0:
+            weights *= 1.0 + (self.pos_weight - 1.0) * fishing_targets
+        # Targets are already 0 where labels are -1, so the masked points
+        # can't produce NaNs, and a plain weighted sum keeps the graph small
+        # enough for XLA to fuse into one kernel.
+        xent = tf.nn.sigmoid_cross_entropy_with_logits(labels=fishing_targets,
+                                                       logits=logits)
+        return tf.reduce_sum(xent * weights)
 
     def build(self, net):
         self.logits = net[:, :, 0]
         self.prediction = tf.sigmoid(self.logits)
 
     def create_loss(self, dense_labels):
-        return self.loss_weight * self.loss_function(dense_labels)
+        return self.loss_function(dense_labels)
 
-    def create_raw_metrics(self, dense_labels):
-        thresholded_prediction = tf.to_int32(self.prediction > 0.5)
-        valid = tf.to_int32(tf.not_equal(dense_labels, -1))
-        labels = tf.to_int32(dense_labels > 0.5)
-        weights = tf.to_float(valid)
+    def create_raw_metrics(self, dense_labels, loss):
         prediction = self.prediction
-
         if self.window:
             b, e = self.window
             prediction = prediction[:, b:e]
             dense_labels = dense_labels[:, b:e]
-            thresholded_prediction = thresholded_prediction[:, b:e]
-            valid = valid[:, b:e]
-            labels = labels[:, b:e]
-            weights = weights[:, b:e]
+
+        thresholded_prediction = tf.cast(prediction > 0.5, tf.int32)
+        labels = tf.cast(dense_labels > 0.5, tf.int32)
+        weights = tf.cast(tf.not_equal(dense_labels, -1), tf.float32)
+
+        precision, recall = precision_and_recall(labels, thresholded_prediction, weights)
 
         return {
             'MSE': tf.metrics.mean_squared_error(prediction, dense_labels, weights=weights),
             'accuracy': tf.metrics.accuracy(labels, thresholded_prediction, weights=weights),
-            'precision': tf.metrics.precision(labels, thresholded_prediction, weights=weights),
-            'recall':    tf.metrics.recall(labels, thresholded_prediction, weights=weights)
+            'precision': precision,
+            'recall':    recall
         }
 
 
 
     def build_json_results(self, prediction, timestamps):
-        InferencePoint = namedtuple('InferencePoint', ['timestamp', 'is_fishing'])
         InferenceRange = namedtuple('InferenceRange', ['start_time', 'end_time', 'score'])
 
         assert (len(prediction) == len(timestamps))
         thresholded_prediction = prediction > 0.5
-        combined = list(six.moves.zip(timestamps, thresholded_prediction))
+        timestamps = np.asarray(timestamps, dtype=np.int64)
         if self.window:
             b, e = self.window
-            combined = combined[b:e]
+            thresholded_prediction = thresholded_prediction[b:e]
+            timestamps = timestamps[b:e]
+        # Convert and format all of the timestamps up front rather than
+        # creating a datetime per point.
+        days = timestamps.astype('datetime64[s]').astype('datetime64[D]')
+        iso_times = timestamps.astype('datetime64[s]').astype(str)
+        iso_days = days.astype(str)
 
         last = None
         fishing_ranges = []
-        for ts_raw, is_fishing in combined:
-            ts = datetime.datetime.utcfromtimestamp(int(ts_raw))
-            if last and last.timestamp >= ts:
+        for i, is_fishing in enumerate(thresholded_prediction):
+            if last is not None and timestamps[last] >= timestamps[i]:
                 logging.warning("last.timestamp >= timestamp")
                 break
-            if last and last.is_fishing == is_fishing:
-                if ts.date() > last.timestamp.date():
+            if last is not None and thresholded_prediction[last] == is_fishing:
+                if days[i] > days[last]:
                     # We are crossing a day boundary here, so break into two ranges
-                    end_of_day = datetime.datetime.combine(last.timestamp.date(), 
-                        datetime.time(hour=23, minute=59, second=59))
                     # TODO: are we skipping a day here if gaps is multi day? Check
-                    start_of_day = datetime.datetime.combine(ts.date(), 
-                        datetime.time(hour=0, minute=0, second=0))
                     fishing_ranges[-1] = fishing_ranges[-1]._replace(
-                                            end_time=end_of_day.isoformat())
+                                            end_time=iso_days[last] + 'T23:59:59')
                     fishing_ranges.append(
-                        InferenceRange(start_of_day.isoformat(), None, is_fishing))
-                fishing_ranges[-1] =  fishing_ranges[-1]._replace(end_time=ts.isoformat())
+                        InferenceRange(iso_days[i] + 'T00:00:00', None, is_fishing))
+                fishing_ranges[-1] =  fishing_ranges[-1]._replace(end_time=iso_times[i])
             else:
                 # TODO, append min(half the distance to previous / next point)
                 # TODO, but maybe we should drop long ranges with no points
                 fishing_ranges.append(
-                    InferenceRange(ts.isoformat(), ts.isoformat(), is_fishing))
-            last = InferencePoint(timestamp=ts, is_fishing=is_fishing)
+                    InferenceRange(iso_times[i], iso_times[i], is_fishing))
+            last = i
 
         return [{'start_time': x.start_time + 'Z',
                  'end_time': x.end_time + 'Z', 'value': float(x.score)}
@@ -0,0 +1,159 @@
+# Copyright 2017 Google Inc. and Skytruth Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import tensorflow as tf
+
+from . import objectives
+
+
+class PrecisionAndRecallTest(tf.test.TestCase):
+    def test_matches_tf_metrics(self):
+        random_state = np.random.RandomState(0)
+        with self.test_session() as sess:
+            labels = tf.placeholder(tf.int32, [None])
+            predictions = tf.placeholder(tf.int32, [None])
+            weights = tf.placeholder(tf.float32, [None])
+            precision, recall = objectives.precision_and_recall(
+                                        labels, predictions, weights)
+            expected_precision = tf.metrics.precision(
+                                        labels, predictions, weights=weights)
+            expected_recall = tf.metrics.recall(
+                                        labels, predictions, weights=weights)
+            sess.run(tf.local_variables_initializer())
+            # Start with an all masked batch, where both are zero.
+            batch_weights = [np.zeros(20)] + [random_state.randint(0, 2, 20)
+                                              for _ in range(4)]
+            for w in batch_weights:
+                feed = {labels: random_state.randint(0, 2, 20),
+                        predictions: random_state.randint(0, 2, 20),
+                        weights: w.astype(np.float32)}
+                expected = sess.run([expected_precision[1], expected_recall[1]],
+                                    feed_dict=feed)
+                actual = sess.run([precision[1], recall[1]], feed_dict=feed)
+                self.assertAllClose(expected, actual)
+                self.assertAllClose(
+                    sess.run([expected_precision[0], expected_recall[0]]),
+                    sess.run([precision[0], recall[0]]))
+
+
+class LossTest(tf.test.TestCase):
+    """Check the weighted losses against the formulas models used before
+    losses were split into `build_loss` and `create_weighted_loss`."""
+
+    def weighted_loss(self, objective, labels):
+        loss = objective.build_loss(tf.constant(labels))
+        with self.test_session() as sess:
+            return sess.run(objective.create_weighted_loss(loss))
+
+    def test_multiclassification_loss(self):
+        random_state = np.random.RandomState(0)
+        objective = objectives.MultiClassificationObjective(
+            'Multiclass', 'Vessel-class', None, loss_weight=0.5)
+        n = objective.num_classes
+        logits = random_state.normal(size=[4, n])
+        prediction = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+        labels = np.zeros([4, n], dtype=np.float32)
+        labels[0, 1] = 1
+        labels[1, [2, 3]] = 1
+        labels[3, 0] = 1
+        # Row 2 is unlabelled and only counts in the mean's denominator.
+        objective.prediction = tf.constant(prediction, dtype=tf.float32)
+
+        mask = labels.sum(axis=1) >= 1
+        positives = (labels * prediction).sum(axis=1)
+        expected = -np.mean(mask * np.log(positives + objectives.EPSILON)) * 0.5
+        self.assertAllClose(expected, self.weighted_loss(objective, labels))
+
+    def check_log_regression_loss(self, objective_class, error):
+        prediction = np.array([1.0, 2.5, -0.5, 3.0], dtype=np.float32)
+        for labels in [np.array([3.0, np.nan, 0.5, 20.0], dtype=np.float32),
+                       np.full([4], np.nan, dtype=np.float32)]:
+            objective = objective_class('length', 'Vessel-length',
+                                        None, loss_weight=0.1)
+            objective.prediction = tf.constant(prediction)
+
+            mask = ~np.isnan(labels)
+            expected = np.where(mask, labels, 0)
+            diff = error((np.log(expected + objectives.EPSILON) - prediction)
+                         * mask)
+            expected_loss = diff.sum() / max(mask.sum(), objectives.EPSILON) * 0.1
+            self.assertAllClose(expected_loss,
+                                self.weighted_loss(objective, labels))
+
+    def test_log_regression_loss(self):
+        self.check_log_regression_loss(objectives.LogRegressionObjective,
+                                       np.square)
+
+    def test_log_regression_mae_loss(self):
+        self.check_log_regression_loss(objectives.LogRegressionObjectiveMAE,
+                                       np.abs)
+
+    def test_fishing_localization_loss(self):
+        random_state = np.random.RandomState(0)
+        logits = random_state.normal(size=[3, 10]).astype(np.float32)
+        labels = random_state.choice([-1.0, 0.0, 1.0], size=[3, 10]).astype(
+            np.float32)
+        objective = objectives.FishingLocalizationObjectiveCrossEntropy(
+            'fishing_localisation', 'fishing-localization', None,
+            loss_weight=0.5)
+        objective.build(tf.constant(logits[:, :, np.newaxis]))
+
+        targets = (labels > 0.5).astype(np.float32)
+        xent = (np.maximum(logits, 0) - logits * targets +
+                np.log1p(np.exp(-np.abs(logits))))
+        expected = np.sum((labels != -1) * xent) * 0.5
+        self.assertAllClose(expected, self.weighted_loss(objective, labels))
+
+
+class FishingLocalizationLossTest(tf.test.TestCase):
+    def old_loss(self, labels, logits, pos_weight, window):
+        b, e = window
+        labels = labels[:, b:e]
+        logits = logits[:, b:e]
+        mask = tf.cast(tf.not_equal(labels, -1), tf.float32)
+        targets = tf.cast(labels > 0.5, tf.float32)
+        return tf.reduce_sum(mask * tf.nn.weighted_cross_entropy_with_logits(
+            targets=targets, logits=logits, pos_weight=pos_weight))
+
+    def test_matches_weighted_cross_entropy(self):
+        random_state = np.random.RandomState(0)
+        window = (2, 8)
+        logits = random_state.normal(size=[4, 10]).astype(np.float32)
+        labels = random_state.choice([-1.0, 0.0, 1.0], size=[4, 10]).astype(
+            np.float32)
+        # Row 1 is fully masked inside the window but not outside it.
+        labels[1, 2:8] = -1
+        labels[1, :2] = 1
+        all_masked = np.full_like(labels, -1)
+        with self.test_session() as sess:
+            for pos_weight in [1.0, 3.0]:
+                for lbls in [labels, all_masked]:
+                    objective = objectives.FishingLocalizationObjectiveCrossEntropy(
+                        'fishing_localisation', 'fishing-localization', None,
+                        window=window)
+                    objective.pos_weight = pos_weight
+                    objective.build(tf.constant(logits[:, :, np.newaxis]))
+                    loss = objective.build_loss(tf.constant(lbls))
+                    expected = self.old_loss(tf.constant(lbls),
+                                             tf.constant(logits),
+                                             pos_weight, window)
+                    loss_value, expected_value = sess.run([loss, expected])
+                    self.assertAllClose(expected_value, loss_value)
+                    if lbls is all_masked:
+                        self.assertEqual(0, loss_value)
+
+
+if __name__ == '__main__':
+    tf.test.main()
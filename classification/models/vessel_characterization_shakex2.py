@@ -20,6 +20,7 @@ from . import layers_shakex2
 from classification import metadata
 from .objectives import (
     TrainNetInfo, MultiClassificationObjective, LogRegressionObjectiveMAE)
+from classification.feature_generation import feature_generation
 from classification.feature_generation import vessel_feature_generation
 import logging
 import math
@@ -78,12 +79,14 @@ class Model(ModelBase):
         class XOrNan:
             def __init__(self, key):
                 self.key = key
+                # Parse every vessel's value once rather than on each call.
+                self.values = {}
+                if vessel_metadata is not None:
+                    for id_, x in vessel_metadata.iter_labels(key):
+                        self.values[id_] = np.float32(np.nan if x == '' else x)
 
             def __call__(self, id_):
-                x = vessel_metadata.vessel_label(self.key, id_)
-                if x == '':
-                    x = np.nan
-                return np.float32(x)
+                return self.values[id_]
 
         self.training_objectives = [
             LogRegressionObjectiveMAE(
@@ -152,9 +155,10 @@ class Model(ModelBase):
 
             global_step = tf.train.get_global_step()
 
-            total_loss = 0
-            for obj in self. training_objectives:
-                total_loss += obj.create_loss(labels[obj.name])
+            losses = [obj.build_loss(labels[obj.name])
+                      for obj in self.training_objectives]
+            total_loss = tf.add_n([obj.create_weighted_loss(loss) for (obj, loss)
+                                   in zip(self.training_objectives, losses)])
 
             learning_rate = tf.train.exponential_decay(
                 self.initial_learning_rate, global_step, 
@@ -174,8 +178,8 @@ class Model(ModelBase):
             assert mode == tf.estimator.ModeKeys.EVAL
 
             eval_metrics = {}
-            for obj in self.training_objectives:
-                eval_metrics.update(obj.create_metrics(labels[obj.name]))
+            for obj, loss in zip(self.training_objectives, losses):
+                eval_metrics.update(obj.create_metrics(labels[obj.name], loss))
 
             return tf.estimator.EstimatorSpec(
               mode=mode,
@@ -198,19 +202,17 @@ class Model(ModelBase):
 
     def make_input_fn(self, base_feature_path, split, parallelism, prefetch):
         def input_fn():
-            return (vessel_feature_generation.input_fn(
-                        self.vessel_metadata,
-                        self.build_training_file_list(base_feature_path, split),
-                        self.num_feature_dimensions + 1,
-                        self.max_window_duration_seconds,
-                        self.window_max_points,
-                        self.min_viable_timeslice_length,
-                        objectives=self.training_objectives,
-                        parallelism=parallelism)
-                .prefetch(prefetch)
-                .shuffle(prefetch)
-                .batch(self.batch_size)
-                )
+            return feature_generation.batch_training_dataset(
+                    vessel_feature_generation.input_fn(
+                            self.vessel_metadata,
+                            self.build_training_file_list(base_feature_path, split),
+                            self.num_feature_dimensions + 1,
+                            self.max_window_duration_seconds,
+                            self.window_max_points,
+                            self.min_viable_timeslice_length,
+                            objectives=self.training_objectives,
+                            parallelism=parallelism),
+                    self.batch_size, prefetch)
         return input_fn
 
     def make_training_input_fn(self, base_feature_path, parallelism, prefetch=1024):
@@ -222,13 +224,14 @@ class Model(ModelBase):
     def make_prediction_input_fn(self, paths, range_info, parallelism):
         time_ranges = range_info
         def input_fn():
-            return vessel_feature_generation.predict_input_fn(
+            return feature_generation.batch_prediction_dataset(
+                    vessel_feature_generation.predict_input_fn(
                             paths,
                             self.num_feature_dimensions + 1,
                             time_ranges,
                             self.window_max_points,
                             self.min_viable_timeslice_length,
-                            parallelism=parallelism
-                    ).batch(1)
+                            parallelism=parallelism),
+                    self.prediction_batch_size)
         return input_fn
 
@@ -42,10 +42,7 @@ class Inferer(object):
 
 
     def _feature_files(self, ids):
-        return [
-            '%s/%s.tfrecord' % (self.root_feature_path, x)
-            for x in ids
-        ]
+        return self.model.feature_file_paths(self.root_feature_path, list(ids))
 
     def _build_time_ranges(self, interval_months, start_date, end_date):
         # TODO: should use min_window_duration here
@@ -83,11 +80,12 @@ class Inferer(object):
 
         for result in self.estimator.predict(input_fn=input_fn):
 
-            start_time, end_time = [datetime.utcfromtimestamp(x) for x in result['time_ranges']]
+            start_time, end_time = np.asarray(result['time_ranges'],
+                                              dtype='datetime64[s]').astype(str)
             output = {
                 'id': result['id'],
-                'start_time': start_time.isoformat(),
-                'end_time': end_time.isoformat()
+                'start_time': str(start_time),
+                'end_time': str(end_time)
             }
             for k, v in result.items():
                 if k in self.model.objective_map:
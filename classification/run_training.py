@@ -14,6 +14,7 @@
 
 from __future__ import absolute_import
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import sys
@@ -61,18 +62,24 @@ def main(args):
         logging.fatal("Could not find metadata file: %s.", metadata_file)
         sys.exit(-1)
 
-    if args.fishing_ranges_file:
-        fishing_ranges_file = os.path.abspath(
-            resource_filename('classification.data', args.fishing_ranges_file))
-        if not os.path.exists(fishing_ranges_file):
-            logging.fatal("Could not find fishing range file: %s.",
-                          fishing_ranges_file)
-            sys.exit(-1)
-        fishing_ranges = metadata.read_fishing_ranges(fishing_ranges_file)
-    else:
-        fishing_ranges = {}
-
-    all_available_ids = metadata.find_available_ids(args.root_feature_path)
+    # The id list is usually read from GCS, so fetch it in the background
+    # while the fishing ranges are parsed.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        available_ids_future = executor.submit(metadata.find_available_ids,
+                                               args.root_feature_path)
+
+        if args.fishing_ranges_file:
+            fishing_ranges_file = os.path.abspath(
+                resource_filename('classification.data', args.fishing_ranges_file))
+            if not os.path.exists(fishing_ranges_file):
+                logging.fatal("Could not find fishing range file: %s.",
+                              fishing_ranges_file)
+                sys.exit(-1)
+            fishing_ranges = metadata.read_fishing_ranges(fishing_ranges_file)
+        else:
+            fishing_ranges = {}
+
+        all_available_ids = available_ids_future.result()
 
     split = None if (args.split == -1) else args.split
     logging.info("Using split: %s", split)
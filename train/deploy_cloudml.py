@@ -17,7 +17,6 @@
 from __future__ import print_function
 from common.gcp_config import GcpConfig
 import yaml
-import json
 import time
 import subprocess
 import os
@@ -41,6 +40,10 @@ def launch(args):
     tf_config_txt = tf_config_template.format(
         output_path=gcp.model_path(), **args.__dict__)
 
+    # gcloud can follow the job's logs itself, streaming new entries as they
+    # arrive rather than having to re-read the whole log to poll it.
+    stream_logs = ['--stream-logs'] if args.stream_logs else []
+
     timestamp = gcp.start_time.strftime('%Y%m%dT%H%M%S')
     job_id = ('%s_%s_%s' % (args.model_name, args.job_name, timestamp)).replace(
         '.', '_').replace('-', '_')
@@ -61,8 +64,8 @@ def launch(args):
             '--config', temp.name, '--module-name',
             'classification.run_training', '--staging-bucket',
             config['staging_bucket'], '--package-path', 'classification',
-            '--region', config['region'], '--'
-        ] + tf_config['trainingInput']['args']
+            '--region', config['region']
+        ] + stream_logs + ['--'] + tf_config['trainingInput']['args']
 
         print('Executing:\n', ' '.join(args))
         print("Config:\n", tf_config_txt)
@@ -91,6 +94,8 @@ if __name__ == "__main__":
                         help='configuration file path.')
     parser.add_argument('--split', default=0, type=int,
                         help='Split to use (-1) for all')
+    parser.add_argument('--stream_logs', action='store_true',
+                        help='follow the job logs after submitting it.')
     args = parser.parse_args()
 
     launch(args)